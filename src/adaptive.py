@@ -0,0 +1,84 @@
+import math
+
+import metrics
+
+LIMIT = metrics.gauge("consumer_concurrency_limit", "Current adaptive limit on deliveries in flight")
+ADJUSTMENTS = metrics.counter("consumer_concurrency_adjustments_total", "Adaptive limit changes", ["direction"])
+
+
+def is_congested(result):
+    """Whether a delivery result says Slack is overloaded: a 429, a timeout
+    or a 5xx. Other failures are about one message or one webhook and are
+    left to the retry queues and the circuit breaker.
+
+    """
+    if result:
+        return False
+    status_code = getattr(result, "status_code", None)
+    return (getattr(result, "rate_limited", False)
+            or getattr(result, "error", None) == "timeout"
+            or (status_code is not None and status_code >= 500))
+
+
+class AIMDController:
+    """Additive-increase, multiplicative-decrease controller for the number
+    of deliveries in flight, kept between floor and ceiling.
+
+    Deliveries are fed in through observe(). Every time update() is called,
+    the window of deliveries seen since the last call is judged. The limit is
+    cut by the decrease factor when more than error_threshold of them were
+    congested or their mean latency went over latency_target. It is raised by
+    increase when the window was healthy and the limit was actually reached.
+    Windows of fewer than min_samples deliveries change nothing.
+
+    """
+
+    def __init__(self, floor, ceiling, initial=None, latency_target=2.0, error_threshold=0.05,
+                 increase=1, decrease=0.7, min_samples=10):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = min(max(initial or floor, floor), ceiling)
+        self.latency_target = latency_target
+        self.error_threshold = error_threshold
+        self.increase = increase
+        self.decrease = decrease
+        self.min_samples = min_samples
+        self._reset()
+        LIMIT.set(self.limit)
+
+    def _reset(self):
+        self._count = 0
+        self._congested = 0
+        self._latency = 0.0
+
+    def observe(self, seconds, result):
+        self._count += 1
+        self._latency += seconds
+        if is_congested(result):
+            self._congested += 1
+
+    def update(self, saturated):
+        """Judge the current window and start a new one.
+
+        :param bool saturated: Whether deliveries were held back by the limit
+        :return: the new limit, or None if it did not change
+
+        """
+        count, congested, latency = self._count, self._congested, self._latency
+        if count < self.min_samples and not (congested and count):
+            return None
+        self._reset()
+        if congested / count > self.error_threshold or latency / count > self.latency_target:
+            limit = max(self.floor, math.floor(self.limit * self.decrease))
+            direction = "down"
+        elif saturated:
+            limit = min(self.ceiling, self.limit + self.increase)
+            direction = "up"
+        else:
+            return None
+        if limit == self.limit:
+            return None
+        self.limit = limit
+        LIMIT.set(limit)
+        ADJUSTMENTS.inc(direction=direction)
+        return limit
@@ -0,0 +1,60 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUED = metrics.gauge("background_tasks_queued", "Background tasks queued or running", ["pool"])
+REJECTED = metrics.counter("background_tasks_rejected_total", "Tasks turned away because the pool was full", ["pool"])
+FAILED = metrics.counter("background_tasks_failed_total", "Background tasks that raised", ["pool"])
+
+
+class BoundedExecutor:
+    """Runs tasks on a thread pool off the request path, with at most
+    max_queued tasks queued or running at once. submit returns False instead
+    of queueing past that, so the caller can shed load rather than let the
+    backlog grow without bound.
+
+    """
+
+    def __init__(self, name, max_workers=4, max_queued=100):
+        self.name = name
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs).
+
+        :return: True if the task was queued, False if the pool is saturated
+
+        """
+        with self._lock:
+            if self._queued >= self.max_queued:
+                REJECTED.inc(pool=self.name)
+                return False
+            self._queued += 1
+            QUEUED.set(self._queued, pool=self.name)
+        self._executor.submit(self._run, fn, args, kwargs)
+        return True
+
+    def _run(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            FAILED.inc(pool=self.name)
+            logger.exception('Background task %s failed', getattr(fn, '__name__', fn))
+        finally:
+            with self._lock:
+                self._queued -= 1
+                QUEUED.set(self._queued, pool=self.name)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
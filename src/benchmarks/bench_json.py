@@ -0,0 +1,60 @@
+"""Per-message CPU of the decode/render/encode path, before and after the
+fast JSON path. Neither side touches the network.
+
+Run from src/:
+
+    python -m benchmarks.bench_json
+    JSON_BACKEND=json python -m benchmarks.bench_json
+
+"""
+import io
+import json
+import time
+import logging
+
+import jsonlib
+from templates import SlackTemplateBuilder, CompiledSlackTemplate
+from benchmarks.bench_templates import make_payload
+
+SIZES = (1, 50, 500)
+
+logger = logging.getLogger("bench_json")
+logger.addHandler(logging.StreamHandler(io.StringIO()))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+
+def before(body):
+    # Consumer.on_message_callback + SlackBot.send_message(json=...) as they were.
+    logger.info('Received message # %s from %s: %s', 1, None, body)
+    payload = json.loads(body.decode('utf8'))
+    template = SlackTemplateBuilder(payload).build_template()
+    return json.dumps(template).encode("utf-8")
+
+
+def after(body, compiled=CompiledSlackTemplate()):
+    logger.info('Received message # %s from %s (%d bytes)', 1, None, len(body))
+    payload = jsonlib.loads(body)
+    return b"".join(compiled.iter_render(SlackTemplateBuilder(payload)))
+
+
+def cpu_per_call(func, body, number):
+    start = time.process_time()
+    for _ in range(number):
+        func(body)
+    return (time.process_time() - start) / number
+
+
+def main():
+    print(f"JSON backend: {jsonlib.BACKEND}")
+    print(f"{'items':>6} {'before':>12} {'after':>12} {'speedup':>8}")
+    for size in SIZES:
+        body = json.dumps({**make_payload(size), "webhook_url": "https://hooks.slack.com/services/x"}).encode()
+        number = max(10, 20000 // size)
+        old = cpu_per_call(before, body, number)
+        new = cpu_per_call(after, body, number)
+        print(f"{size:>6} {old * 1e6:>9.1f} us {new * 1e6:>9.1f} us {old / new:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""End-to-end throughput and latency of Publisher -> Consumer -> SlackBot,
+offline.
+
+RabbitMQ is replaced by the in-memory broker from benchmarks.fake_amqp and
+hooks.slack.com by benchmarks.slack_stub, running in its own process. Each
+configuration runs in a fresh process so peak RSS is per configuration.
+
+Run from src/:
+
+    python -m benchmarks.bench_pipeline --messages 2000 --items 1 50 --concurrency 1 10 50 --latency 0.02
+
+Compare broker bytes with and without body compression:
+
+    python -m benchmarks.bench_pipeline --items 1 50 500 --concurrency 10 --compression off deflate auto
+
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import resource
+import threading
+import multiprocessing
+
+from benchmarks.bench_templates import make_payload
+from benchmarks.fake_amqp import FakeBroker, FakeConnection, FakeSelectConnection
+from benchmarks import slack_stub
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_once(args, concurrency, items, compression, stub_url, results):
+    # Read at import time by slack.py and ratelimit.py.
+    os.environ["SLACK_POOL_MAXSIZE"] = str(concurrency)
+    os.environ["SLACK_RATE_LIMIT"] = str(args.rate_limit)
+    os.environ["SLACK_RATE_BURST"] = str(max(1, int(args.rate_limit)))
+
+    from tornado.ioloop import IOLoop
+    from consumer import Consumer
+    from publisher import Publisher
+
+    if not args.log:
+        logging.disable(logging.ERROR)
+
+    ioloop = IOLoop.current()
+    latencies = []
+
+    def on_ack(latency):
+        latencies.append(latency)
+        if len(latencies) == args.messages:
+            ioloop.stop()
+
+    broker = FakeBroker(ioloop, on_ack=on_ack)
+
+    class BenchConsumer(Consumer):
+        def connect(self):
+            return FakeConnection(broker, self.on_connection_open)
+
+    class BenchPublisher(Publisher):
+        def create_connection(self):
+            return FakeSelectConnection(
+                broker,
+                on_open_callback=self._on_connection_open,
+                on_close_callback=self._on_connection_closed,
+            )
+
+    bodies = []
+    for i in range(args.messages):
+        payload = make_payload(items)
+        payload["id"] = f"finding-{i}"
+        payload["webhook_url"] = f"{stub_url}/services/{i % args.webhooks}"
+        bodies.append(payload)
+
+    def load():
+        with BenchPublisher("amqp://bench", "notification_queue", window=args.window, compression=compression,
+                            compress_threshold=args.compress_threshold) as publisher:
+            publisher.publish_many(("slack.observed", json.dumps(body)) for body in bodies)
+
+    started = {}
+
+    def start_load_when_consuming():
+        if not broker.consuming:
+            ioloop.call_later(0.01, start_load_when_consuming)
+            return
+        started["at"] = time.perf_counter()
+        threading.Thread(target=load, daemon=True).start()
+
+    consumer = BenchConsumer(
+        amqp_url="amqp://bench",
+        exchange_name="notification_queue",
+        binding_keys=["slack.observed"],
+        queue_name="bench",
+        max_in_flight=concurrency,
+    )
+    ioloop.add_callback(start_load_when_consuming)
+    consumer.run()
+    elapsed = time.perf_counter() - started["at"]
+
+    latencies.sort()
+    results.put({
+        "concurrency": concurrency,
+        "items": items,
+        "compression": compression,
+        "rate": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "bytes": broker.bytes_in,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 50], help="resource_items per payload")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50], help="max in-flight deliveries")
+    parser.add_argument("--webhooks", type=int, default=100, help="distinct webhook urls")
+    parser.add_argument("--window", type=int, default=1000, help="publisher confirm window")
+    parser.add_argument("--rate-limit", type=float, default=1000.0, help="sends per second per webhook")
+    parser.add_argument("--latency", type=float, default=0.02, help="mean Slack stub response time")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limited", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--compression", nargs="+", default=["off"], help="off, deflate, zstd, lz4 or auto")
+    parser.add_argument("--compress-threshold", type=int, default=1024, help="smallest body to compress")
+    parser.add_argument("--log", action="store_true", help="keep logging on")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    receive, send = context.Pipe(duplex=False)
+    stub = context.Process(
+        target=slack_stub.serve,
+        args=(0, args.latency, args.error_rate, args.rate_limited, 1, send),
+        daemon=True,
+    )
+    stub.start()
+    stub_url = receive.recv()
+
+    print(f"{'codec':>8} {'conc':>5} {'items':>6} {'msg/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'RSS MB':>7} {'broker MB':>9}")
+    try:
+        for compression in args.compression:
+            for items in args.items:
+                for concurrency in args.concurrency:
+                    results = context.Queue()
+                    worker = context.Process(
+                        target=run_once, args=(args, concurrency, items, compression, stub_url, results))
+                    worker.start()
+                    r = results.get()
+                    worker.join()
+                    print(f"{r['compression']:>8} {r['concurrency']:>5} {r['items']:>6} {r['rate']:>9.1f} "
+                          f"{r['p50'] * 1e3:>8.1f} {r['p95'] * 1e3:>8.1f} {r['p99'] * 1e3:>8.1f} {r['rss']:>7.1f} {r['bytes'] / 2 ** 20:>9.2f}")
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
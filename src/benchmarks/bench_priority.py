@@ -0,0 +1,76 @@
+"""Latency of Critical findings stuck behind a flood of Low ones, with the
+delivery engine scheduling by severity and with the old plain FIFO.
+
+A backlog of --messages findings is submitted at once, one in --every of
+them Critical, to an engine with --concurrency slots whose handler takes
+--latency seconds, as if the consumer had just been handed a full prefetch
+window. Latency is measured from submit to completion.
+
+Run from src/:
+
+    python -m benchmarks.bench_priority --messages 2000 --every 100 --concurrency 10 --latency 0.005
+
+"""
+import time
+import argparse
+
+from tornado.ioloop import IOLoop
+
+from delivery import Delivery, DeliveryEngine
+from priority import severity_priority
+from benchmarks.bench_pipeline import percentile
+
+
+def run_once(args, prioritised):
+    ioloop = IOLoop()
+    latencies = {"Critical": [], "Low": []}
+    remaining = [args.messages]
+
+    def handler(_payload):
+        time.sleep(args.latency)
+        return True
+
+    def on_done(delivery, _result):
+        severity, submitted = delivery.payload
+        latencies[severity].append(time.perf_counter() - submitted)
+        remaining[0] -= 1
+        if not remaining[0]:
+            ioloop.stop()
+
+    engine = DeliveryEngine(ioloop, on_done, max_in_flight=args.concurrency)
+
+    def submit_all():
+        for i in range(args.messages):
+            severity = "Critical" if i % args.every == args.every - 1 else "Low"
+            engine.submit(Delivery(
+                None, [i], handler, (severity, time.perf_counter()),
+                priority=severity_priority(severity) if prioritised else 0,
+            ))
+
+    ioloop.add_callback(submit_all)
+    ioloop.start()
+    ioloop.close()
+    for values in latencies.values():
+        values.sort()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--every", type=int, default=100, help="one Critical finding per this many")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per Slack send")
+    args = parser.parse_args()
+
+    print(f"{'scheduler':>10} {'severity':>9} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for name, prioritised in (("fifo", False), ("priority", True)):
+        latencies = run_once(args, prioritised)
+        for severity in ("Critical", "Low"):
+            values = latencies[severity]
+            print(f"{name:>10} {severity:>9} {percentile(values, 0.50) * 1e3:>8.1f} "
+                  f"{percentile(values, 0.95) * 1e3:>8.1f} {values[-1] * 1e3:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
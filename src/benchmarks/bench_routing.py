@@ -0,0 +1,86 @@
+"""Cost of finding the handlers for a routing key with hundreds of topic
+patterns registered: the trie in routing.HandlerRegistry, uncached and
+through the resolve() cache, against testing every pattern in turn.
+
+Run from src/:
+
+    python -m benchmarks.bench_routing --patterns 100 500 1000
+
+"""
+import re
+import time
+import random
+import argparse
+
+from routing import HandlerRegistry
+
+CHANNELS = ("slack", "email", "teams", "pagerduty", "webhook", "sms")
+EVENTS = ("observed", "resolved", "escalated", "digest", "muted")
+
+
+def make_patterns(count, rng):
+    patterns = []
+    for i in range(count):
+        channel = rng.choice(CHANNELS)
+        tenant = f"tenant{i}"
+        shape = i % 4
+        if shape == 0:
+            patterns.append(f"{channel}.{tenant}.{rng.choice(EVENTS)}")
+        elif shape == 1:
+            patterns.append(f"{channel}.{tenant}.*")
+        elif shape == 2:
+            patterns.append(f"{channel}.{tenant}.#")
+        else:
+            patterns.append(f"*.{tenant}.{rng.choice(EVENTS)}")
+    return patterns
+
+
+def make_keys(count, patterns, rng):
+    tenants = len(patterns)
+    return [f"{rng.choice(CHANNELS)}.tenant{rng.randrange(tenants)}.{rng.choice(EVENTS)}" for _ in range(count)]
+
+
+def topic_regex(pattern):
+    parts = []
+    for word in pattern.split("."):
+        parts.append({"*": r"[^.]+", "#": r".*"}.get(word, re.escape(word)))
+    return re.compile(r"\.".join(parts).replace(r"\..*", r"(\..*)?").replace(r".*\.", r"(.*\.)?") + "$")
+
+
+def per_call(func, keys):
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patterns", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--keys", type=int, default=20000)
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    print(f"{'patterns':>8} {'linear':>12} {'trie':>12} {'cached':>12}")
+    for count in args.patterns:
+        patterns = make_patterns(count, rng)
+        registry = HandlerRegistry(cache_size=args.keys)
+        compiled = []
+        for i, pattern in enumerate(patterns):
+            handler = lambda payload, i=i: i
+            registry.register(pattern, handler)
+            compiled.append((topic_regex(pattern), handler))
+        keys = make_keys(args.keys, patterns, rng)
+
+        def linear(key):
+            return [handler for regex, handler in compiled if regex.match(key)]
+
+        old = per_call(linear, keys)
+        trie = per_call(registry.match, keys)
+        per_call(registry.resolve, keys)
+        cached = per_call(registry.resolve, keys)
+        print(f"{count:>8} {old * 1e6:>9.2f} us {trie * 1e6:>9.2f} us {cached * 1e6:>9.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Compare the dict-building template path with CompiledSlackTemplate.
+
+Run from src/:
+
+    python -m benchmarks.bench_templates
+
+"""
+import json
+import timeit
+
+from templates import SlackTemplateBuilder, CompiledSlackTemplate
+
+SIZES = (1, 50, 5000)
+
+
+def make_payload(items):
+    return {
+        "title": "S3 Bucket Encryption",
+        "id": "sample-id",
+        "description": "Enable bucket encryption",
+        "severity_type": "Critical",
+        "compliance": "PCI-DSS",
+        "resource_type": "Storage",
+        "resource_items": [{"name": f"bucket{i}", "id": f"id{i}"} for i in range(items)],
+    }
+
+
+def build_and_dump(builder):
+    # What SlackBot used to do: build the tree, then let requests serialize it.
+    return json.dumps(builder.build_template()).encode("utf-8")
+
+
+def main():
+    compiled = CompiledSlackTemplate()
+    print(f"{'items':>6} {'dict+dumps':>14} {'compiled':>14} {'speedup':>8}")
+    for size in SIZES:
+        builder = SlackTemplateBuilder(make_payload(size))
+        assert compiled.render(builder) == build_and_dump(builder)
+
+        number = max(1, 20000 // size)
+        before = min(timeit.repeat(lambda: build_and_dump(builder), number=number, repeat=5)) / number
+        after = min(timeit.repeat(lambda: compiled.render(builder), number=number, repeat=5)) / number
+        print(f"{size:>6} {before * 1e6:>11.1f} us {after * 1e6:>11.1f} us {before / after:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Cold start of the Flask app: how long `import web` takes and how long the
+first request takes after that, each measured in a fresh interpreter the way
+an autoscaled worker boots. No network is used; BOT_ID is set so auth.test is
+never called, and the first request is a signed url_verification challenge.
+
+Run from src/:
+
+    python -m benchmarks.bench_web_startup --runs 20
+
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import hashlib
+import argparse
+import statistics
+import subprocess
+
+SIGNING_SECRET = "bench-secret"
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import web
+imported = time.perf_counter()
+body, headers = json.loads(sys.argv[1])
+response = web.app.test_client().post("/slack/events", data=body, headers=headers)
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(json.dumps({"import": imported - started, "first_request": done - imported}))
+"""
+
+
+def signed_challenge():
+    body = json.dumps({"type": "url_verification", "challenge": "bench"})
+    timestamp = str(int(time.time()))
+    signature = "v0=" + hmac.new(
+        SIGNING_SECRET.encode(), f"v0:{timestamp}:{body}".encode(), hashlib.sha256).hexdigest()
+    return body, {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": signature}
+
+
+def run_once():
+    env = dict(os.environ, SIGNING_SECRET=SIGNING_SECRET, BOT_ID=os.getenv("BOT_ID", "UBENCH"))
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, json.dumps(signed_challenge())],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    print(f"{'':>14} {'median ms':>10} {'max ms':>8}")
+    for name in ("import", "first_request"):
+        values = [run[name] for run in runs]
+        print(f"{name:>14} {statistics.median(values) * 1e3:>10.1f} {max(values) * 1e3:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""In-memory stand-in for RabbitMQ, with pika-compatible connections and
+channels for both sides of the pipeline:
+
+* FakeConnection runs on the consumer's Tornado IOLoop and implements what
+  Consumer uses of TornadoConnection and its channel.
+* FakeSelectConnection runs on its own thread like Publisher's
+  SelectConnection, and confirms every publish as soon as it is routed.
+
+Only the behaviour the benchmarks and tests depend on is modelled: topic
+routing, prefetch, acks, redelivery of what was unacked when a channel
+closes, and publisher confirms.
+
+"""
+import time
+import threading
+import itertools
+from collections import deque
+from types import SimpleNamespace
+
+import pika
+
+
+def topic_matches(pattern, routing_key):
+    """AMQP topic match: * is exactly one word, # is zero or more words."""
+    def match(p, k):
+        if not p:
+            return not k
+        if p[0] == "#":
+            return any(match(p[1:], k[i:]) for i in range(len(k) + 1))
+        return bool(k) and p[0] in ("*", k[0]) and match(p[1:], k[1:])
+    return match(pattern.split("."), routing_key.split("."))
+
+
+def _frame(**method):
+    return SimpleNamespace(method=SimpleNamespace(**method))
+
+
+class _Message:
+    __slots__ = ("exchange", "routing_key", "body", "properties", "published_at", "redelivered")
+
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body if isinstance(body, bytes) else body.encode("utf-8")
+        self.properties = properties or pika.BasicProperties()
+        self.published_at = time.perf_counter()
+        self.redelivered = False
+
+
+class FakeBroker:
+    """Exchanges, queues and bindings shared by every fake connection.
+
+    on_ack, if set, is called on the consumer IOLoop with the publish-to-ack
+    latency of every acknowledged message.
+
+    """
+
+    def __init__(self, ioloop, on_ack=None):
+        self.ioloop = ioloop
+        self.on_ack = on_ack
+        self.bindings = {}
+        self.queues = {}
+        self.consuming = set()
+        self.bytes_in = 0
+        self._names = itertools.count(1)
+
+    def declare_queue(self, name):
+        name = name or f"amq.gen-{next(self._names)}"
+        self.queues.setdefault(name, deque())
+        return name
+
+    def bind(self, exchange, queue, routing_key):
+        self.bindings.setdefault(exchange, []).append((routing_key, queue))
+
+    def publish(self, message):
+        """Route a message. Safe to call from any thread."""
+        self.bytes_in += len(message.body)
+        self.ioloop.add_callback(self._route, message)
+
+    def _route(self, message):
+        queues = set()
+        if message.exchange == "":
+            queues.add(message.routing_key)
+        for pattern, queue in self.bindings.get(message.exchange, ()):
+            if topic_matches(pattern, message.routing_key):
+                queues.add(queue)
+        for queue in queues:
+            if queue in self.queues:
+                self.queues[queue].append(message)
+        for channel in list(self.consuming):
+            channel.dispatch()
+
+
+class FakeChannel:
+    """The subset of pika.channel.Channel used by Consumer."""
+
+    def __init__(self, connection, number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = number
+        self.is_open = True
+        self._prefetch = 0
+        self._unacked = {}
+        self._tags = itertools.count(1)
+        self._consumers = {}
+        self._close_callbacks = []
+
+    def __int__(self):
+        return self.channel_number
+
+    def _reply(self, callback, frame=None):
+        if callback:
+            self.connection.ioloop.add_callback(callback, frame or _frame())
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        pass
+
+    def basic_qos(self, prefetch_count=0, callback=None, **_kwargs):
+        self._prefetch = prefetch_count
+        self._reply(callback)
+
+    def exchange_declare(self, exchange, callback=None, **_kwargs):
+        self._reply(callback)
+
+    def queue_declare(self, queue, callback=None, **_kwargs):
+        name = self.broker.declare_queue(queue)
+        self._reply(callback, _frame(queue=name))
+
+    def queue_bind(self, queue, exchange, routing_key=None, callback=None, **_kwargs):
+        self.broker.bind(exchange, queue, routing_key)
+        self._reply(callback)
+
+    def basic_consume(self, queue, on_message_callback, **_kwargs):
+        consumer_tag = f"ctag-{next(self._tags)}"
+        self._consumers[consumer_tag] = (queue, on_message_callback)
+        self.broker.consuming.add(self)
+        self.connection.ioloop.add_callback(self.dispatch)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag, callback=None):
+        self._consumers.pop(consumer_tag, None)
+        if not self._consumers:
+            self.broker.consuming.discard(self)
+        self._reply(callback)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **_kwargs):
+        self.broker.publish(_Message(exchange, routing_key, body, properties))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        _queue_name, message = self._unacked.pop(delivery_tag)
+        if self.broker.on_ack:
+            self.broker.on_ack(time.perf_counter() - message.published_at)
+        self.dispatch()
+
+    def dispatch(self):
+        for queue_name, callback in list(self._consumers.values()):
+            queue = self.broker.queues[queue_name]
+            while queue and (not self._prefetch or len(self._unacked) < self._prefetch):
+                message = queue.popleft()
+                delivery_tag = next(self._tags)
+                self._unacked[delivery_tag] = (queue_name, message)
+                method = SimpleNamespace(
+                    delivery_tag=delivery_tag,
+                    routing_key=message.routing_key,
+                    exchange=message.exchange,
+                    redelivered=message.redelivered,
+                )
+                callback(self, method, message.properties, message.body)
+
+    def close(self):
+        self.is_open = False
+        self.broker.consuming.discard(self)
+        # Unacked messages go back to the head of their queue, in order.
+        for queue_name, message in reversed(list(self._unacked.values())):
+            message.redelivered = True
+            self.broker.queues[queue_name].appendleft(message)
+        self._unacked.clear()
+        for channel in list(self.broker.consuming):
+            self.connection.ioloop.add_callback(channel.dispatch)
+        for callback in self._close_callbacks:
+            self.connection.ioloop.add_callback(callback, self, "closed")
+
+
+class FakeConnection:
+    """Stands in for TornadoConnection, on the same Tornado IOLoop."""
+
+    def __init__(self, broker, on_open_callback):
+        self.broker = broker
+        self.ioloop = broker.ioloop
+        self.is_open = True
+        self._close_callbacks = []
+        self._channels = itertools.count(1)
+        self.ioloop.add_callback(on_open_callback, self)
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def channel(self, on_open_callback):
+        self.ioloop.add_callback(on_open_callback, FakeChannel(self, next(self._channels)))
+
+    def close(self):
+        self.is_open = False
+        for callback in self._close_callbacks:
+            self.ioloop.add_callback(callback, self, "closed")
+
+
+class _ThreadIOLoop:
+    """Just enough of pika's select_connection.IOLoop for Publisher."""
+
+    def __init__(self):
+        self._callbacks = deque()
+        self._wakeup = threading.Condition()
+        self._running = False
+
+    def add_callback_threadsafe(self, callback):
+        with self._wakeup:
+            self._callbacks.append(callback)
+            self._wakeup.notify()
+
+    def start(self):
+        self._running = True
+        while self._running:
+            with self._wakeup:
+                self._wakeup.wait_for(lambda: self._callbacks)
+                callback = self._callbacks.popleft()
+            callback()
+
+    def stop(self):
+        self._running = False
+
+
+class _FakeConfirmChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._confirm = None
+        self._tags = itertools.count(1)
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def exchange_declare(self, exchange, callback=None, **_kwargs):
+        callback(_frame())
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self._confirm = ack_nack_callback
+        callback(_frame())
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **_kwargs):
+        self.connection.broker.publish(_Message(exchange, routing_key, body, properties))
+        if self._confirm:
+            # Like RabbitMQ, confirm after basic_publish has returned.
+            method = pika.spec.Basic.Ack(delivery_tag=next(self._tags), multiple=False)
+            self.connection.ioloop.add_callback_threadsafe(lambda: self._confirm(SimpleNamespace(method=method)))
+
+
+class FakeSelectConnection:
+    """Stands in for the SelectConnection Publisher runs on its IO thread."""
+
+    def __init__(self, broker, on_open_callback, on_close_callback, **_kwargs):
+        self.broker = broker
+        self.ioloop = _ThreadIOLoop()
+        self.is_open = True
+        self._on_close = on_close_callback
+        self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self))
+
+    def channel(self, on_open_callback):
+        on_open_callback(_FakeConfirmChannel(self))
+
+    def close(self):
+        self.is_open = False
+        self._on_close(self, "closed")
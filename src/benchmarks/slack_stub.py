@@ -0,0 +1,88 @@
+"""Local stand-in for hooks.slack.com with configurable latency, error rate
+and 429 rate.
+
+Run on its own from src/:
+
+    python -m benchmarks.slack_stub --port 8765 --latency 0.05 --rate-limited 0.01
+
+"""
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SlackStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle plus
+    # delayed ACKs add ~40ms to every response.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(server.latency / 2, server.latency * 1.5))
+
+        roll = random.random()
+        if roll < server.rate_limited:
+            self._reply(429, b"rate_limited", {"Retry-After": str(server.retry_after)})
+        elif roll < server.rate_limited + server.error_rate:
+            self._reply(500, b"internal_error")
+        else:
+            self._reply(200, b"ok")
+        with server.lock:
+            server.requests += 1
+
+    def _reply(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):
+        pass
+
+
+class SlackStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, rate_limited=0.0, retry_after=1):
+        super().__init__(("127.0.0.1", port), SlackStubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+def serve(port, latency, error_rate, rate_limited, retry_after, ready=None):
+    stub = SlackStub(port, latency, error_rate, rate_limited, retry_after)
+    if ready is not None:
+        ready.send(stub.url)
+    stub.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500 responses")
+    parser.add_argument("--rate-limited", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    print(f"Slack stub listening on 127.0.0.1:{args.port}")
+    serve(args.port, args.latency, args.error_rate, args.rate_limited, args.retry_after)
+
+
+if __name__ == "__main__":
+    main()
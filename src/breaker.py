@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+
+OPEN = metrics.gauge("slack_breaker_open", "Webhooks whose circuit breaker is open or half-open")
+DEAD = metrics.gauge("slack_breaker_dead", "Webhooks cached as permanently dead")
+FAST_FAILURES = metrics.counter(
+    "slack_breaker_fast_failures_total", "Sends failed without a request by the circuit breaker", ["reason"])
+TRIPS = metrics.counter("slack_breaker_trips_total", "Times a circuit breaker opened")
+
+# Slack's answers for a webhook that will never work again: the channel or
+# the app was removed, or the url was revoked.
+PERMANENT_STATUSES = frozenset((404, 410))
+PERMANENT_ERRORS = frozenset((
+    "channel_not_found", "channel_is_archived", "invalid_token", "no_service", "no_active_hooks",
+    "team_disabled", "action_prohibited",
+))
+
+
+class _Circuit:
+    __slots__ = ("failures", "open_until", "open_for", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.open_for = 0.0
+        self.probing = False
+
+
+class CircuitBreaker:
+    """Per-webhook circuit breaker with a negative cache of dead webhooks.
+
+    A webhook that answers with a permanent error is cached as dead for
+    dead_ttl seconds, and every send to it fails straight away. After
+    failure_threshold transient failures in a row (timeouts, connection
+    errors, 5xx) the circuit opens for open_seconds: sends fail straight away
+    until a single probe is let through. A successful probe closes the circuit,
+    a failed one opens it again for twice as long, up to max_open_seconds.
+
+    Other 4xx answers, rate limiting included, say nothing about the webhook
+    itself and count as neither.
+    State is in-process and capped at max_keys webhooks each.
+
+    """
+
+    def __init__(self, failure_threshold=5, open_seconds=30.0, max_open_seconds=600.0, dead_ttl=3600.0,
+                 max_keys=10000):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.dead_ttl = dead_ttl
+        self.max_keys = max_keys
+        self._circuits = OrderedDict()
+        self._dead = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Check whether a send to key may go ahead.
+
+        :param str key: The webhook url
+        :return: None to send, otherwise why the send must fail fast,
+            "dead" or "open"
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            dead_until = self._dead.get(key)
+            if dead_until is not None:
+                if dead_until > now:
+                    FAST_FAILURES.inc(reason="dead")
+                    return "dead"
+                del self._dead[key]
+                DEAD.set(len(self._dead))
+            circuit = self._circuits.get(key)
+            if circuit is None or not circuit.open_until:
+                return None
+            if circuit.open_until > now:
+                FAST_FAILURES.inc(reason="open")
+                return "open"
+            # Half-open: let this send through as the probe and hold the
+            # others back, even if the probe never reports back.
+            circuit.probing = True
+            circuit.open_until = now + circuit.open_for
+            return None
+
+    def record(self, key, status_code=None, error=None, success=False):
+        """Feed the outcome of a send to key back into its circuit."""
+        with self._lock:
+            if success:
+                self._close(key)
+            elif is_permanent(status_code, error):
+                self._close(key)
+                self._dead.pop(key, None)
+                self._dead[key] = time.monotonic() + self.dead_ttl
+                if len(self._dead) > self.max_keys:
+                    self._dead.popitem(last=False)
+                DEAD.set(len(self._dead))
+            elif status_code is None or status_code >= 500:
+                self._fail(key)
+
+    def _close(self, key):
+        if self._circuits.pop(key, None) is not None:
+            self._update_open()
+
+    def _fail(self, key):
+        circuit = self._circuits.pop(key, None) or _Circuit()
+        self._circuits[key] = circuit
+        if len(self._circuits) > self.max_keys:
+            self._circuits.popitem(last=False)
+        circuit.failures += 1
+        if circuit.probing or (not circuit.open_until and circuit.failures >= self.failure_threshold):
+            circuit.open_for = min(circuit.open_for * 2 or self.open_seconds, self.max_open_seconds)
+            circuit.open_until = time.monotonic() + circuit.open_for
+            circuit.probing = False
+            TRIPS.inc()
+            self._update_open()
+
+    def _update_open(self):
+        OPEN.set(sum(1 for circuit in self._circuits.values() if circuit.open_until))
+
+
+def is_permanent(status_code, error=None):
+    if status_code in PERMANENT_STATUSES:
+        return True
+    return bool(error) and status_code is not None and str(error).strip() in PERMANENT_ERRORS
+
+
+def circuit_breaker_from_env():
+    return CircuitBreaker(
+        failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5)),
+        open_seconds=float(os.getenv("BREAKER_OPEN_SECONDS", 30)),
+        max_open_seconds=float(os.getenv("BREAKER_MAX_OPEN_SECONDS", 600)),
+        dead_ttl=float(os.getenv("DEAD_WEBHOOK_TTL", 3600)),
+    )
@@ -0,0 +1,68 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Buffer:
+    __slots__ = ("delivery_tags", "payloads", "timeout")
+
+    def __init__(self):
+        self.delivery_tags = []
+        self.payloads = []
+        self.timeout = None
+
+
+class Coalescer:
+    """Buffers payloads per key on the IOLoop and hands them over in one go,
+    either window seconds after the first payload for that key arrived or as
+    soon as max_count payloads are buffered, whichever comes first.
+
+    on_flush is called as on_flush(key, delivery_tags, payloads). The count
+    trigger can only fire when the channel prefetch is at least max_count,
+    otherwise the window is what bounds the batch.
+
+    """
+
+    def __init__(self, ioloop, on_flush, window=2.0, max_count=20):
+        self.ioloop = ioloop
+        self.on_flush = on_flush
+        self.window = window
+        self.max_count = max_count
+        self._buffers = {}
+
+    def add(self, key, delivery_tag, payload):
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = _Buffer()
+            buffer.timeout = self.ioloop.call_later(self.window, self.flush, key)
+        buffer.delivery_tags.append(delivery_tag)
+        buffer.payloads.append(payload)
+        if len(buffer.payloads) >= self.max_count:
+            self.flush(key)
+
+    def flush(self, key):
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            return
+        self.ioloop.remove_timeout(buffer.timeout)
+        logger.info('Flushing %s coalesced messages', len(buffer.payloads))
+        self.on_flush(key, buffer.delivery_tags, buffer.payloads)
+
+    def flush_all(self):
+        for key in list(self._buffers):
+            self.flush(key)
+
+    def drop(self, predicate):
+        """Forget the buffers whose key matches predicate without flushing
+        them, e.g. those of a channel that has closed.
+
+        :return: the payloads of each dropped buffer
+        :rtype: list
+
+        """
+        dropped = []
+        for key in [key for key in self._buffers if predicate(key)]:
+            buffer = self._buffers.pop(key)
+            self.ioloop.remove_timeout(buffer.timeout)
+            dropped.append(buffer.payloads)
+        return dropped
@@ -0,0 +1,153 @@
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Message bodies are compressed as a whole and labelled with one of these in
+# the AMQP content_encoding property; anything else is passed through as is.
+DEFLATE = "deflate"
+ZSTD = "zstd"
+LZ4 = "lz4"
+
+# A body that inflates past this is rejected rather than decoded.
+MAX_DECOMPRESSED_BYTES = int(os.getenv("MAX_DECOMPRESSED_BYTES", 64 * 2 ** 20))
+
+_CHUNK = 64 * 1024
+
+
+class DecompressionError(ValueError):
+    pass
+
+
+# What each codec raises for a corrupt body, turned into DecompressionError.
+_CODEC_ERRORS = (zlib.error,)
+if zstandard is not None:
+    _CODEC_ERRORS += (zstandard.ZstdError,)
+if lz4 is not None:
+    _CODEC_ERRORS += (RuntimeError,)
+
+
+def available():
+    """Encodings usable in this process, best first."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append(ZSTD)
+    if lz4 is not None:
+        encodings.append(LZ4)
+    encodings.append(DEFLATE)
+    return encodings
+
+
+def resolve_encoding(name):
+    """Map a BODY_COMPRESSION setting to an encoding: off (None), auto for
+    the best one installed, or deflate, zstd or lz4 by name.
+
+    """
+    if not name or name == "off":
+        return None
+    if name == "auto":
+        return available()[0]
+    if name not in available():
+        raise RuntimeError(f"BODY_COMPRESSION={name} is not available, expected one of {available()}")
+    return name
+
+
+def compress(body, encoding, level=None):
+    if encoding == DEFLATE:
+        return zlib.compress(body, 6 if level is None else level)
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(body)
+    if encoding == LZ4:
+        return lz4.frame.compress(body, compression_level=0 if level is None else level)
+    raise ValueError(f"Unknown content encoding {encoding!r}")
+
+
+def decompress(body, encoding, max_size=None):
+    """Decode a body according to its content_encoding, chunk by chunk so that
+    a body inflating past max_size is refused before it is fully expanded.
+    Bodies without a content encoding, or with one that is not a codec of
+    ours such as utf-8 or identity, are returned untouched. A body that one
+    of our codecs can't decode raises DecompressionError.
+
+    """
+    if not encoding:
+        return body
+    max_size = max_size or MAX_DECOMPRESSED_BYTES
+    try:
+        if encoding == DEFLATE:
+            return _inflate(body, max_size)
+        if encoding == ZSTD:
+            if zstandard is None:
+                raise DecompressionError(
+                    "Received a zstd body but zstandard is not installed, run: pip install zstandard")
+            return _read_zstd(body, max_size)
+        if encoding == LZ4:
+            if lz4 is None:
+                raise DecompressionError("Received an lz4 body but lz4 is not installed, run: pip install lz4")
+            return _read_lz4(body, max_size)
+    except _CODEC_ERRORS as e:
+        raise DecompressionError(f"Corrupt {encoding} body: {e}") from e
+    return body
+
+
+def _inflate(body, max_size):
+    decoder = zlib.decompressobj()
+    chunks = _Chunks(max_size)
+    data = body
+    while not decoder.eof:
+        chunk = decoder.decompress(data, _CHUNK)
+        data = decoder.unconsumed_tail
+        if not chunk and not data:
+            raise DecompressionError("Truncated deflate body")
+        chunks.append(chunk)
+    return chunks.join()
+
+
+def _read_zstd(body, max_size):
+    chunks = _Chunks(max_size)
+    with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+        while True:
+            chunk = reader.read(_CHUNK)
+            if not chunk:
+                return chunks.join()
+            chunks.append(chunk)
+
+
+def _read_lz4(body, max_size):
+    decoder = lz4.frame.LZ4FrameDecompressor()
+    chunks = _Chunks(max_size)
+    data = body
+    while not decoder.eof:
+        # Input left over from a call is kept by the decoder itself.
+        chunk = decoder.decompress(data, _CHUNK)
+        data = b""
+        if not chunk and decoder.needs_input:
+            raise DecompressionError("Truncated lz4 body")
+        chunks.append(chunk)
+    return chunks.join()
+
+
+class _Chunks:
+    __slots__ = ("max_size", "size", "chunks")
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+
+    def append(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise DecompressionError(f"Body inflates past {self.max_size} bytes")
+        self.chunks.append(chunk)
+
+    def join(self):
+        return b"".join(self.chunks)
@@ -1,33 +1,127 @@
-import json
+import os
+import copy
+import math
+import time
 import logging
 import pika
+import jsonlib
+import metrics
+from logpipeline import MessageLogger
 from pika.adapters.tornado_connection import TornadoConnection
-from slack import slack_event_handler
+from compression import decompress
+from tracing import TRACE_HEADER, tracer_from_env
+import slack  # registers the Slack handlers
+from routing import FUNC_HANDLERS, BATCH_HANDLERS
+from delivery import Delivery, DeliveryEngine, SENT_FIELD
+from coalesce import Coalescer
+from dedup import seen_cache_from_env, finding_key
+from ratelimit import rate_limiter_from_env
+from priority import severity_priority
+from adaptive import AIMDController
+from sharding import SHARD_EXCHANGE_TYPE, SHARD_HEADER
 from pika.exchange_type import ExchangeType
 
-LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
-              '-35s %(lineno) -5d: %(message)s')
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
-
-FUNC_HANDLERS = {
-    "slack.observed": slack_event_handler
-}
+# Per-message lines, sampled at LOG_SAMPLE_RATE.
+message_log = MessageLogger(__name__ + ".messages")
+
+MESSAGES_RECEIVED = metrics.counter(
+    "consumer_messages_received_total", "Messages received from RabbitMQ", ["routing_key"])
+MESSAGES_ACKED = metrics.counter(
+    "consumer_messages_acked_total", "Messages acknowledged to RabbitMQ", ["routing_key"])
+DECODE_SECONDS = metrics.histogram(
+    "consumer_json_decode_seconds", "Time spent decompressing and decoding message bodies",
+    buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025))
+RECONNECTS = metrics.counter("consumer_reconnects_total", "Connections re-opened after being lost")
+RETRIED = metrics.counter(
+    "consumer_messages_retried_total", "Failed messages sent to a delay queue", ["routing_key"])
+DEAD_LETTERED = metrics.counter(
+    "consumer_messages_dead_lettered_total", "Messages given up on after max_attempts", ["routing_key"])
+DUPLICATES = metrics.counter(
+    "consumer_duplicates_skipped_total", "Messages acked without delivery because they were already sent",
+    ["routing_key"])
 
 
 class Consumer:
 
     EXCHANGE_TYPE = ExchangeType.topic
-
-    def __init__(self, amqp_url, exchange_name, binding_keys, queue_name=""):
+    # Headers carried by retried messages. The original routing key has to
+    # travel in a header because delay queues dead-letter straight to our
+    # queue through the default exchange, which rewrites the routing key.
+    RETRY_COUNT_HEADER = "x-retry-count"
+    ORIGINAL_ROUTING_KEY_HEADER = "x-original-routing-key"
+    LAST_ERROR_HEADER = "x-last-error"
+    # How many messages of a multi-message payload were already accepted.
+    MESSAGES_SENT_HEADER = "x-messages-sent"
+    # Seconds a failed delivery waits before each retry, with a named queue.
+    DEFAULT_RETRY_DELAYS = (5, 30, 120, 600)
+
+    def __init__(self, amqp_url, exchange_name, binding_keys, queue_name="", max_in_flight=10,
+                 prefetch_count=None, coalesce_window=0, coalesce_max=20, durable=False,
+                 drain_timeout=30, retry_delays=None, max_attempts=5, max_priority=None,
+                 shard_exchange=None, shard_weight=1, retire_shard=False, queue_expires=None, concurrency_floor=1,
+                 concurrency_ceiling=None, latency_target=2.0, adjust_interval=5.0, max_deferred_per_key=None):
+        # Delay and dead-letter queues are named after our queue. A server
+        # named queue gets a reserved amq.gen- name, which may not be used as
+        # a prefix, and a new one on every reconnect, so it has no retries
+        # unless asked for, which is an error.
+        if retry_delays is None:
+            retry_delays = self.DEFAULT_RETRY_DELAYS if queue_name else ()
+        elif retry_delays and not queue_name:
+            raise ValueError("retry_delays needs a queue_name")
         self.queue_name = queue_name
+        self.server_named = not queue_name
+        # With a ceiling above max_in_flight, the number of deliveries in
+        # flight and the prefetch follow Slack's latency and error rate.
+        self.concurrency_floor = concurrency_floor
+        self.concurrency_ceiling = concurrency_ceiling
+        self.latency_target = latency_target
+        self.adjust_interval = adjust_interval
+        self.shard_exchange = shard_exchange
+        self.shard_weight = shard_weight
+        # Whether our shard is being removed for good, in which case it is
+        # taken off the ring when we stop, see leave_ring.
+        self.retire_shard = retire_shard
+        # Seconds our queue, and its delay and dead-letter queues, may go
+        # unused before RabbitMQ deletes them, so a shard whose consumer is
+        # gone for good drops off the ring.
+        self.queue_expires = queue_expires
+        self.max_priority = max_priority
+        self.retry_delays = retry_delays
+        self.max_attempts = max_attempts
+        self.durable = durable
+        self.drain_timeout = drain_timeout
         self.exchange_name = exchange_name
         self.binding_keys = binding_keys
+        self.max_in_flight = max_in_flight
+        # Prefetching more than max_in_flight lets messages for a paced
+        # webhook wait in memory without starving every other webhook, as
+        # long as no webhook may hold more than max_deferred_per_key of them.
+        # Any more go to the first delay queue.
+        self.prefetch_count = prefetch_count or 4 * max_in_flight
+        self.max_deferred_per_key = max_deferred_per_key or max_in_flight
+        self.coalesce_window = coalesce_window
+        self.coalesce_max = coalesce_max
         self._url = amqp_url
         self._connection = None
         self._consumer_tag = None
         self._channel = None
         self._closing = False
+        self._stop_requested = False
+        self._delivery = None
+        self._coalescer = None
+        self._seen = None
+        self._controller = None
+        self._tracer = None
+        # Traces of the sampled messages not acked yet, by delivery tag.
+        self._traces = {}
+        # Idempotency keys of deliveries in progress, each with the duplicates
+        # that arrived before that delivery finished. They wait for its
+        # outcome: acked once it is sent, delivered in its place if it fails.
+        self._claimed = {}
+        # (routing key, body, properties) of every unacked message by delivery
+        # tag, kept so a failed delivery can be republished for a retry.
+        self._sources = {}
 
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
@@ -90,8 +184,34 @@ class Consumer:
         """
         logging.info('Channel opened')
         self._channel = channel
+        self._consumer_tag = None
+        self._sources = {}
+        self._traces = {}
+        self.release_stale_claims(channel)
         self.add_on_channel_close_callback()
+        self.set_qos()
+
+    def set_qos(self):
+        """Limit the number of unacknowledged messages RabbitMQ will push to
+        us to the number of deliveries we are willing to have in flight. The
+        on_basic_qos_ok method will be invoked by pika once it is applied.
+
+        """
+        if self._controller is not None:
+            self.prefetch_count = self.prefetch_for(self._controller.limit)
+        logging.info('Setting prefetch count to %s', self.prefetch_count)
+        self._channel.basic_qos(
+            prefetch_count=self.prefetch_count,
+            callback=self.on_basic_qos_ok,
+        )
 
+    def on_basic_qos_ok(self, _unused_frame):
+        """Invoked by pika when the Basic.QoS method has completed. We can
+        now declare the exchange.
+
+        :param pika.frame.Method _unused_frame: The Basic.QosOk response frame
+
+        """
         logging.info('Declaring exchange %s', self.exchange_name)
         self._channel.exchange_declare(
             callback=self.on_exchange_declare_ok,
@@ -99,6 +219,29 @@ class Consumer:
             exchange_type=self.EXCHANGE_TYPE,
         )
 
+    def prefetch_for(self, limit):
+        """Prefetch that keeps the configured prefetch_count/max_in_flight
+        ratio for a given in-flight limit.
+
+        """
+        return math.ceil(limit * self._prefetch_ratio)
+
+    def adjust_concurrency(self):
+        """Invoked on the IOLoop every adjust_interval seconds when the limit
+        is adaptive. Applies the controller's new in-flight limit to the
+        delivery engine and re-issues Basic.Qos with the matching prefetch.
+
+        """
+        limit = self._controller.update(self._delivery.saturated)
+        if limit is not None:
+            logging.info('Adjusting deliveries in flight to %s', limit)
+            self._delivery.set_limit(limit)
+            self.prefetch_count = self.prefetch_for(limit)
+            if self._channel is not None and self._channel.is_open:
+                self._channel.basic_qos(prefetch_count=self.prefetch_count)
+        if not self._closing:
+            self._connection.ioloop.call_later(self.adjust_interval, self.adjust_concurrency)
+
     def add_on_channel_close_callback(self):
         """This method tells pika to call the on_channel_closed method if
         RabbitMQ unexpectedly closes the channel.
@@ -143,6 +286,7 @@ class Consumer:
         """
         if not self._closing:
             # Create a new connection
+            RECONNECTS.inc()
             self._connection = self.connect()
 
     def close_channel(self):
@@ -150,17 +294,45 @@ class Consumer:
         Channel.Close RPC command.
 
         """
-        logging.info('Closing the channel')
-        self._channel.close()
+        if self._channel and self._channel.is_open:
+            logging.info('Closing the channel')
+            self._channel.close()
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
         Basic.Cancel RPC command.
 
         """
-        if self._channel:
+        if self._channel and self._channel.is_open and self._consumer_tag is not None:
             logging.info('Sending a Basic.Cancel RPC command to RabbitMQ')
-            self._channel.basic_cancel(self.close_channel, self._consumer_tag)
+            self._channel.basic_cancel(self._consumer_tag, self.on_cancelok)
+        elif self._channel and self._channel.is_open:
+            # Not consuming on this channel yet, so there is nothing to drain.
+            # Closing it closes the connection, which stops the IOLoop.
+            self.close_channel()
+        else:
+            self._connection.ioloop.stop()
+
+    def on_cancelok(self, _unused_frame):
+        """Invoked by pika when RabbitMQ acknowledges the cancellation of a
+        consumer. No new messages will arrive, so we flush anything still
+        buffered and wait for the deliveries already in progress to be acked
+        before closing the channel, giving up after drain_timeout seconds.
+        Whatever is left unacked then is redelivered by RabbitMQ.
+
+        :param pika.frame.Method _unused_frame: The Basic.CancelOk frame
+
+        """
+        logging.info('RabbitMQ acknowledged the cancellation of the consumer, draining')
+        if self._coalescer:
+            self._coalescer.flush_all()
+        timeout = self._connection.ioloop.call_later(self.drain_timeout, self.close_channel)
+
+        def drained():
+            self._connection.ioloop.remove_timeout(timeout)
+            self.close_channel()
+
+        self._delivery.when_idle(drained)
 
     def run(self):
         """Run the example consumer by connecting to RabbitMQ and then
@@ -168,6 +340,39 @@ class Consumer:
 
         """
         self._connection = self.connect()
+        self._prefetch_ratio = self.prefetch_count / self.max_in_flight
+        if self.concurrency_ceiling:
+            self._controller = AIMDController(
+                self.concurrency_floor,
+                self.concurrency_ceiling,
+                initial=self.max_in_flight,
+                latency_target=self.latency_target,
+            )
+            self._connection.ioloop.call_later(self.adjust_interval, self.adjust_concurrency)
+        if self.queue_expires and not self.server_named:
+            self._connection.ioloop.call_later(self.queue_expires / 2, self.renew_retry_queues)
+        self._delivery = DeliveryEngine(
+            self._connection.ioloop,
+            self.on_delivery_done,
+            max_in_flight=self._controller.limit if self._controller else self.max_in_flight,
+            rate_limiter=rate_limiter_from_env(),
+            controller=self._controller,
+            max_workers=self.concurrency_ceiling,
+            on_overflow=self.on_delivery_overflow if self.retry_delays and not self.server_named else None,
+            max_deferred_per_key=self.max_deferred_per_key,
+        )
+        self._tracer = tracer_from_env()
+        self._seen = seen_cache_from_env("findings", ttl=int(os.getenv("DEDUP_TTL", 86400)))
+        self._content_hash = os.getenv("DEDUP_CONTENT_HASH", "") == "1"
+        if self.coalesce_window:
+            self._coalescer = Coalescer(
+                self._connection.ioloop,
+                self.on_coalesced,
+                window=self.coalesce_window,
+                max_count=self.coalesce_max,
+            )
+        if self._stop_requested:
+            self._connection.ioloop.add_callback(self.shutdown)
         self._connection.ioloop.start()
 
     def stop(self):
@@ -181,11 +386,48 @@ class Consumer:
         the IOLoop will be buffered but not processed.
 
         """
+        self.shutdown()
+        self._connection.ioloop.start()
+        logging.info('Stopped')
+
+    def request_stop(self, _signum=None, _frame=None):
+        """Signal handler that stops the consumer like stop(), with the IOLoop
+        left running. The shutdown is only scheduled here, since the signal
+        may arrive in the middle of any callback, e.g. between republishing a
+        failed message and acking it.
+
+        """
+        self._stop_requested = True
+        if self._connection is not None:
+            self._connection.ioloop.add_callback_from_signal(self.shutdown)
+
+    def shutdown(self):
+        """Start stopping the consumer, on the IOLoop. Once the deliveries in
+        progress are drained, the connection is closed and the IOLoop stops.
+
+        """
+        if self._closing:
+            return
         logging.info('Stopping')
         self._closing = True
+        if self.retire_shard:
+            self.leave_ring()
         self.stop_consuming()
-        self._connection.ioloop.start()
-        logging.info('Stopped')
+
+    def leave_ring(self):
+        """Unbind our shard queue from the hash exchange, so that no more
+        findings hash to it, before it is abandoned. Whatever is still in it
+        is dead-lettered to the remaining shards, see on_exchange_declare_ok.
+
+        """
+        if not self.shard_exchange or self._channel is None or not self._channel.is_open:
+            return
+        logging.info('Unbinding %s from %s', self.queue_name, self.shard_exchange)
+        self._channel.queue_unbind(
+            queue=self.queue_name,
+            exchange=self.shard_exchange,
+            routing_key=str(self.shard_weight),
+        )
 
     def on_exchange_declare_ok(self, _unused_frame):
         """Invoked by pika when RabbitMQ has finished the Exchange.Declare RPC
@@ -194,9 +436,28 @@ class Consumer:
         :param pika.Frame.Method _unused_frame: Exchange.DeclareOk response frame
 
         """
+        if self._closing:
+            return
         logging.info('Exchange declared queue')
+        if self.shard_exchange:
+            self.setup_shard_exchange()
+        # Changing priorities or the expiry changes the queue's arguments, so an
+        # existing queue has to be deleted first or RabbitMQ closes the channel.
+        arguments = {}
+        if self.max_priority:
+            arguments["x-max-priority"] = self.max_priority
+        if self.queue_expires:
+            arguments["x-expires"] = int(self.queue_expires * 1000)
+            if self.shard_exchange:
+                # Expiring deletes whatever is still in the queue. Messages
+                # left in it for half that long are dead-lettered back onto
+                # the ring instead, to another shard once it is unbound.
+                arguments["x-message-ttl"] = int(self.queue_expires * 500)
+                arguments["x-dead-letter-exchange"] = self.shard_exchange
         self._channel.queue_declare(
             queue=self.queue_name,
+            durable=self.durable,
+            arguments=arguments or None,
             callback=self.on_queue_declare_ok,
         )
 
@@ -210,18 +471,103 @@ class Consumer:
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
         """
+        if self._closing:
+            return
         _queue_name = method_frame.method.queue
         self.queue_name = _queue_name
-        print("[*] Waiting for data for " + _queue_name + ".To exit press CTRL+C")
-        for binding_key in self.binding_keys:
+        logging.info('Waiting for data on %s', _queue_name)
+        self.setup_retry_queues()
+        if self.shard_exchange:
+            logging.info('Binding %s to %s with weight %s', self.shard_exchange, _queue_name, self.shard_weight)
+            self._channel.queue_bind(
+                queue=_queue_name,
+                exchange=self.shard_exchange,
+                routing_key=str(self.shard_weight),
+                callback=self.start_consuming,
+            )
+            return
+        # Channel RPCs are handled in order, so consuming starts once the
+        # last binding is in place.
+        for index, binding_key in enumerate(self.binding_keys, 1):
             logging.info('Binding %s to %s with %s', self.exchange_name, _queue_name, binding_key)
             self._channel.queue_bind(
                 queue=_queue_name,
                 exchange=self.exchange_name,
                 routing_key=binding_key,
-                callback=self.start_consuming,
+                callback=self.start_consuming if index == len(self.binding_keys) else None,
             )
 
+    def setup_shard_exchange(self):
+        """Declare the consistent-hash exchange and bind it to our exchange
+        with every binding key. Our queue is then bound to the hash exchange
+        alone, as one shard of the ring, with shard_weight as its share.
+
+        """
+        logging.info('Declaring shard exchange %s', self.shard_exchange)
+        self._channel.exchange_declare(
+            exchange=self.shard_exchange,
+            exchange_type=SHARD_EXCHANGE_TYPE,
+            durable=self.durable,
+            arguments={"hash-header": SHARD_HEADER},
+        )
+        for binding_key in self.binding_keys:
+            logging.info('Binding %s to %s with %s', self.exchange_name, self.shard_exchange, binding_key)
+            self._channel.exchange_bind(
+                destination=self.shard_exchange,
+                source=self.exchange_name,
+                routing_key=binding_key,
+            )
+
+    def retry_queue_name(self, delay):
+        return f"{self.queue_name}.retry.{int(delay * 1000)}"
+
+    def dead_letter_queue_name(self):
+        return f"{self.queue_name}.dead"
+
+    def setup_retry_queues(self):
+        """Declare one delay queue per retry tier and the dead-letter queue.
+        Nothing consumes from a delay queue: a message sits there until its
+        x-message-ttl expires and RabbitMQ dead-letters it back onto our queue
+        through the default exchange. Retries therefore never sleep or hold a
+        prefetch slot on this consumer. Channel RPCs are handled in order, so
+        these are in place before the first message can fail.
+
+        With queue_expires they expire along with our queue. Publishing does
+        not count as using a queue, so renew_retry_queues declares them again
+        while we are running.
+
+        A server-named queue gets neither, see __init__.
+
+        """
+        if self.server_named:
+            return
+        expires = {"x-expires": int(self.queue_expires * 1000)} if self.queue_expires else {}
+        for delay in self.retry_delays:
+            logging.info('Declaring retry queue %s', self.retry_queue_name(delay))
+            self._channel.queue_declare(
+                queue=self.retry_queue_name(delay),
+                durable=self.durable,
+                arguments={
+                    "x-message-ttl": int(delay * 1000),
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": self.queue_name,
+                    **expires,
+                },
+            )
+        logging.info('Declaring dead-letter queue %s', self.dead_letter_queue_name())
+        self._channel.queue_declare(queue=self.dead_letter_queue_name(), durable=self.durable,
+                                    arguments=expires or None)
+
+    def renew_retry_queues(self):
+        """Invoked on the IOLoop every queue_expires / 2 seconds. Declaring
+        the delay and dead-letter queues again renews their expiry.
+
+        """
+        if self._channel is not None and self._channel.is_open and self._consumer_tag is not None:
+            self.setup_retry_queues()
+        if not self._closing:
+            self._connection.ioloop.call_later(self.queue_expires / 2, self.renew_retry_queues)
+
     def start_consuming(self, _unused_frame):
         """This method sets up the consumer by first calling
         add_on_cancel_callback so that the object is notified if RabbitMQ
@@ -232,6 +578,8 @@ class Consumer:
         will invoke when a message is fully received.
         :param pika.frame.Method _unused_frame: The Queue.BindOk response frame
         """
+        if self._closing:
+            return
         logging.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
         self._consumer_tag = self._channel.basic_consume(
@@ -260,13 +608,293 @@ class Consumer:
             self._channel.close()
 
     def on_message_callback(self, _channel, method, _properties, body):
-        binding_key = method.routing_key
-        logging.info('Received message # %s from %s: %s', method.delivery_tag, _properties.app_id, body)
-        if binding_key in FUNC_HANDLERS:
-            FUNC_HANDLERS[binding_key](json.loads(body.decode('utf8')))
+        trace = None
+        if self._tracer is not None:
+            trace = self._tracer.start((_properties.headers or {}).get(TRACE_HEADER))
+            if trace is not None:
+                self._traces[method.delivery_tag] = trace
+        try:
+            self.handle_message(_channel, method, _properties, body, trace)
+        except Exception as e:
+            # Anything escaping a pika callback takes the connection down
+            # with it, and every delivery still unacked along with it.
+            logging.exception('Could not handle message %s', method.delivery_tag)
+            self.abandon_message(method.delivery_tag, e)
+        if trace is not None:
+            trace.record("receive", trace.started)
+
+    def abandon_message(self, delivery_tag, error):
+        """Send a message that failed before reaching a handler to a retry,
+        or to the dead-letter queue once out of attempts, and ack it. A
+        message already handed over to the delivery engine or the coalescer
+        is left to them.
+
+        :param int delivery_tag: The delivery tag of the failed message
+        :param Exception error: What went wrong
+
+        """
+        source = self._sources.pop(delivery_tag, None)
+        if source is None:
+            return
+        try:
+            self.retry_or_dead_letter(*source, str(error))
+            self.acknowledge_message(delivery_tag)
+        except Exception:
+            logging.exception('Could not retry message %s, leaving it unacked', delivery_tag)
+            return
+        MESSAGES_ACKED.inc(routing_key=source[0])
+
+    def handle_message(self, _channel, method, _properties, body, trace=None):
+        headers = _properties.headers or {}
+        binding_key = headers.get(self.ORIGINAL_ROUTING_KEY_HEADER, method.routing_key)
+        self._sources[method.delivery_tag] = (binding_key, body, _properties)
+        message_log.info('received', delivery_tag=method.delivery_tag, routing_key=binding_key,
+                         app_id=_properties.app_id, bytes=len(body))
+        MESSAGES_RECEIVED.inc(routing_key=binding_key)
+        handler = FUNC_HANDLERS.resolve(binding_key)
+        if handler is not None:
+            started = time.perf_counter()
+            try:
+                payload = jsonlib.loads(decompress(body, _properties.content_encoding))
+                if not isinstance(payload, dict):
+                    raise ValueError(f"Expected a JSON object, got {type(payload).__name__}")
+            except ValueError as e:
+                # Nothing will ever decode this body, so it is not retried.
+                logging.error('Could not decode message %s: %s', method.delivery_tag, e)
+                self.retry_or_dead_letter(*self._sources.pop(method.delivery_tag), str(e), permanent=True)
+                self.acknowledge_message(method.delivery_tag)
+                MESSAGES_ACKED.inc(routing_key=binding_key)
+                return
+            DECODE_SECONDS.observe(time.perf_counter() - started)
+            if trace is not None:
+                trace.record("decode", started)
+            if headers.get(self.MESSAGES_SENT_HEADER):
+                payload[SENT_FIELD] = int(headers[self.MESSAGES_SENT_HEADER])
+            self.admit(_channel, method.delivery_tag, binding_key, handler, payload, trace)
         else:
-            logging.info("not register handler.")
-        self.acknowledge_message(method.delivery_tag)
+            message_log.info('no handler', delivery_tag=method.delivery_tag, routing_key=binding_key)
+            self._sources.pop(method.delivery_tag, None)
+            self.acknowledge_message(method.delivery_tag)
+            MESSAGES_ACKED.inc(routing_key=binding_key)
+
+    def on_coalesced(self, key, delivery_tags, payloads):
+        """Invoked by the coalescer when a batch for one webhook is ready.
+        The whole batch goes out as a single delivery and all of its delivery
+        tags are acked together once it has been sent.
+
+        :param tuple key: The (channel, routing key, webhook url) of the batch
+        :param list delivery_tags: Delivery tags of the buffered messages
+        :param list payloads: The buffered payloads, in arrival order
+
+        """
+        channel, binding_key, webhook_url = key
+        idempotency_keys = [self.idempotency_key(payload) for payload in payloads] if self._seen else []
+        idempotency_keys = [key for key in idempotency_keys if key]
+        try:
+            self._delivery.submit(Delivery(
+                channel, delivery_tags, BATCH_HANDLERS.resolve(binding_key), payloads,
+                key=webhook_url, routing_key=binding_key,
+                idempotency_keys=idempotency_keys,
+                priority=max(severity_priority(payload.get("severity_type")) for payload in payloads),
+                trace=next((self._traces[tag] for tag in delivery_tags if tag in self._traces), None),
+            ))
+        except Exception as e:
+            # The whole batch failed, not just the message whose arrival
+            # flushed it.
+            logging.exception('Could not submit %s coalesced messages', len(delivery_tags))
+            for idempotency_key in idempotency_keys:
+                self.release_claim(idempotency_key, sent=False)
+            for delivery_tag in delivery_tags:
+                self.abandon_message(delivery_tag, e)
+
+    def idempotency_key(self, payload):
+        if SENT_FIELD in payload:
+            payload = {key: value for key, value in payload.items() if key != SENT_FIELD}
+        return finding_key(payload, content_hash=self._content_hash)
+
+    def admit(self, channel, delivery_tag, binding_key, handler, payload, trace=None):
+        """Check a decoded payload against the deliveries in progress and the
+        seen cache, before any rendering or HTTP work is done, and hand it to
+        the coalescer or the delivery engine. A duplicate of a delivery in
+        progress is parked until that delivery finishes, see release_claim;
+        one already sent is acked straight away.
+
+        """
+        idempotency_key = self.idempotency_key(payload) if self._seen is not None else None
+        if idempotency_key is not None:
+            if idempotency_key in self._claimed:
+                message_log.info('duplicate in progress', delivery_tag=delivery_tag, routing_key=binding_key)
+                self._claimed[idempotency_key].append(
+                    (channel, delivery_tag, binding_key, handler, payload, trace))
+                return
+            if self._seen.seen(idempotency_key):
+                message_log.info('duplicate', delivery_tag=delivery_tag, routing_key=binding_key)
+                DUPLICATES.inc(routing_key=binding_key)
+                self._sources.pop(delivery_tag, None)
+                self.acknowledge_message(delivery_tag)
+                MESSAGES_ACKED.inc(routing_key=binding_key)
+                return
+            self._claimed[idempotency_key] = []
+        webhook_url = payload.get("webhook_url")
+        try:
+            if self._coalescer and BATCH_HANDLERS.resolve(binding_key) is not None:
+                self._coalescer.add((channel, binding_key, webhook_url), delivery_tag, payload)
+                return
+            self._delivery.submit(Delivery(
+                channel, [delivery_tag], handler, payload,
+                key=webhook_url, routing_key=binding_key,
+                idempotency_keys=[idempotency_key] if idempotency_key else (),
+                priority=severity_priority(payload.get("severity_type")),
+                trace=trace,
+            ))
+        except Exception:
+            # Otherwise the retry would be parked behind a claim never released.
+            if idempotency_key is not None:
+                self.release_claim(idempotency_key, sent=False)
+            raise
+
+    def release_claim(self, key, sent):
+        """Release the claim on an idempotency key and settle the duplicates
+        parked behind it: once sent, they are acked as duplicates; otherwise
+        the first of them is delivered instead and the rest park behind it.
+
+        :param str key: The idempotency key
+        :param bool sent: Whether the claiming delivery was sent
+
+        """
+        parked = self._claimed.pop(key, None)
+        if sent:
+            self._seen.add(key)
+        for channel, delivery_tag, *message in parked or ():
+            if channel is not self._channel or delivery_tag not in self._sources:
+                continue
+            try:
+                self.admit(channel, delivery_tag, *message)
+            except Exception as e:
+                logging.exception('Could not handle message %s', delivery_tag)
+                self.abandon_message(delivery_tag, e)
+
+    def release_stale_claims(self, channel):
+        """Invoked when a new channel opens. Messages of the previous channel
+        can no longer be acked and RabbitMQ redelivers them, so duplicates
+        parked on it are forgotten, and so are batches still buffered for it,
+        with their claims. Deliveries already handed to the delivery engine
+        keep theirs until they finish, so that their redelivered copies wait
+        for the outcome instead of being sent twice.
+
+        :param pika.channel.Channel channel: The channel just opened
+
+        """
+        for parked in self._claimed.values():
+            parked.clear()
+        if self._coalescer is None:
+            return
+        for payloads in self._coalescer.drop(lambda key: key[0] is not channel):
+            for payload in payloads:
+                key = self.idempotency_key(payload) if self._seen is not None else None
+                if key is not None:
+                    self.release_claim(key, sent=False)
+
+    def on_delivery_done(self, delivery, result):
+        """Invoked on the IOLoop by the delivery engine once a handler has
+        finished. Delivery tags are only valid on the channel they arrived on,
+        so anything that completes after a reconnect is left for RabbitMQ to
+        redeliver.
+
+        :param Delivery delivery: The finished delivery
+        :param result: Whatever the handler returned
+
+        """
+        for key in delivery.idempotency_keys:
+            self.release_claim(key, sent=bool(result))
+        if delivery.channel is not self._channel or not self._channel.is_open:
+            logging.warning('Channel gone, not acknowledging messages %s', delivery.delivery_tags)
+            return
+        self.acknowledge_delivery(delivery, retry=not result, error=getattr(result, "error", None),
+                                  permanent=getattr(result, "permanent", False))
+
+    def on_delivery_overflow(self, delivery):
+        """Invoked by the delivery engine, instead of parking a delivery on
+        the rate limiter, when its webhook has max_deferred_per_key deliveries
+        waiting already. Its messages are moved to the first delay queue,
+        without counting as an attempt, so they stop holding prefetch slots.
+
+        :param Delivery delivery: The delivery handed back
+
+        """
+        if delivery.channel is not self._channel or not self._channel.is_open:
+            for key in delivery.idempotency_keys:
+                self.release_claim(key, sent=False)
+            return
+        self.acknowledge_delivery(delivery, retry=True, error="webhook rate limited", deferred=True)
+        # Duplicates parked behind it are over the limit as well, and follow
+        # it to the delay queue.
+        for key in delivery.idempotency_keys:
+            self.release_claim(key, sent=False)
+
+    def acknowledge_delivery(self, delivery, retry=False, error=None, permanent=False, deferred=False):
+        """Ack every message of a delivery, with retry after republishing those
+        not sent yet through retry_or_dead_letter.
+
+        """
+        sources = [self._sources.pop(delivery_tag, None) for delivery_tag in delivery.delivery_tags]
+        if retry:
+            # A coalesced batch drops payloads from the front of its list as
+            # they are sent, so only the trailing messages still need a retry.
+            unsent = delivery.payload if isinstance(delivery.payload, list) else [delivery.payload]
+            for source, payload in zip(sources[len(sources) - len(unsent):], unsent):
+                if source is not None:
+                    sent = payload.get(SENT_FIELD) if isinstance(payload, dict) else None
+                    self.retry_or_dead_letter(*source, error, permanent=permanent, messages_sent=sent,
+                                              deferred=deferred)
+        for delivery_tag in delivery.delivery_tags:
+            self.acknowledge_message(delivery_tag)
+        MESSAGES_ACKED.inc(len(delivery.delivery_tags), routing_key=delivery.routing_key)
+
+    def retry_or_dead_letter(self, routing_key, body, properties, error=None, permanent=False,
+                             messages_sent=None, deferred=False):
+        """Republish a failed message to the delay queue for its attempt, or to
+        the dead-letter queue once it has been tried max_attempts times or
+        failed permanently. The original is acked by the caller right after,
+        on the same channel. With a server-named queue it is only dropped.
+
+        :param str routing_key: The routing key the message was first sent with
+        :param bytes body: The original message body
+        :param pika.spec.BasicProperties properties: The original properties
+        :param str error: Why the last attempt failed
+        :param bool permanent: Whether no retry can succeed
+        :param int messages_sent: Messages of the payload already accepted,
+            skipped by the retry
+        :param bool deferred: Whether the message was only held back, in
+            which case it goes to the first delay queue and is not counted as
+            an attempt
+
+        """
+        if self.server_named:
+            logging.error('Dropping failed message, a server-named queue has no dead-letter queue: %s', error)
+            DEAD_LETTERED.inc(routing_key=routing_key)
+            return
+        headers = dict(properties.headers or {})
+        attempt = int(headers.get(self.RETRY_COUNT_HEADER, 0)) + (0 if deferred else 1)
+        headers[self.RETRY_COUNT_HEADER] = attempt
+        headers[self.ORIGINAL_ROUTING_KEY_HEADER] = routing_key
+        if error:
+            headers[self.LAST_ERROR_HEADER] = str(error)[:255]
+        if messages_sent:
+            headers[self.MESSAGES_SENT_HEADER] = messages_sent
+        properties = copy.copy(properties)
+        properties.headers = headers
+
+        if not deferred and (permanent or attempt >= self.max_attempts or not self.retry_delays):
+            logging.warning('Giving up on message after %s attempts: %s', attempt, error)
+            queue = self.dead_letter_queue_name()
+            DEAD_LETTERED.inc(routing_key=routing_key)
+        else:
+            delay = self.retry_delays[min(max(attempt, 1), len(self.retry_delays)) - 1]
+            message_log.info('retrying', routing_key=routing_key, delay=delay, attempt=attempt, error=error)
+            queue = self.retry_queue_name(delay)
+            RETRIED.inc(routing_key=routing_key)
+        self._channel.basic_publish(exchange="", routing_key=queue, body=body, properties=properties)
 
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
@@ -275,11 +903,22 @@ class Consumer:
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
-        logging.info('Acknowledging message %s', delivery_tag)
+        message_log.info('ack', delivery_tag=delivery_tag)
+        trace = self._traces.pop(delivery_tag, None)
+        started = time.perf_counter()
         self._channel.basic_ack(delivery_tag)
+        if trace is not None:
+            trace.record("ack", started)
+            trace.finish()
 
     def execute(self):
         try:
             self.run()
         except KeyboardInterrupt:
             self.stop()
+        else:
+            logging.info('Stopped')
+        finally:
+            # Forked workers exit without running atexit handlers.
+            if self._tracer is not None:
+                self._tracer.close()
@@ -0,0 +1,123 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import jsonlib
+import metrics
+from redis_client import get_redis
+
+HITS = metrics.counter("dedup_hits_total", "Lookups that found the key already seen", ["cache"])
+MISSES = metrics.counter("dedup_misses_total", "Lookups that found the key not seen yet", ["cache"])
+
+
+class LocalSeenCache:
+    """In-process set of recently seen keys with a TTL, capped at max_keys
+    entries by evicting the least recently added key.
+
+    """
+
+    def __init__(self, name, ttl=86400, max_keys=100000):
+        self.name = name
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        now = time.monotonic()
+        with self._lock:
+            expires = self._expires.get(key)
+            if expires is not None and expires <= now:
+                del self._expires[key]
+                expires = None
+        return self._count(expires is not None)
+
+    def add(self, key):
+        with self._lock:
+            self._add(key)
+
+    def add_if_absent(self, key):
+        """Add key unless it is already seen, in one step, so that of two
+        callers racing on the same key exactly one gets True.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            expires = self._expires.get(key)
+            hit = expires is not None and expires > now
+            if not hit:
+                self._add(key)
+        return not self._count(hit)
+
+    def discard(self, key):
+        with self._lock:
+            self._expires.pop(key, None)
+
+    def _add(self, key):
+        self._expires.pop(key, None)
+        self._expires[key] = time.monotonic() + self.ttl
+        while len(self._expires) > self.max_keys:
+            self._expires.popitem(last=False)
+
+    def _count(self, hit):
+        (HITS if hit else MISSES).inc(cache=self.name)
+        return hit
+
+
+class RedisSeenCache:
+    """Same contract as LocalSeenCache, shared by every process through Redis
+    keys that expire on their own.
+
+    """
+
+    def __init__(self, name, ttl=86400, client=None, prefix=None):
+        self.name = name
+        self.ttl = ttl
+        self.prefix = prefix or f"dedup:{name}:"
+        self._redis = client or get_redis()
+
+    def seen(self, key):
+        return self._count(bool(self._redis.exists(self.prefix + key)))
+
+    def add(self, key):
+        self._redis.set(self.prefix + key, 1, ex=self.ttl)
+
+    def add_if_absent(self, key):
+        return not self._count(not self._redis.set(self.prefix + key, 1, ex=self.ttl, nx=True))
+
+    def discard(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def _count(self, hit):
+        (HITS if hit else MISSES).inc(cache=self.name)
+        return hit
+
+
+def seen_cache_from_env(name, ttl):
+    """Build the cache selected by DEDUP_BACKEND: memory (default), redis or
+    off, in which case None is returned.
+
+    """
+    backend = os.getenv("DEDUP_BACKEND", "memory")
+    if backend == "off":
+        return None
+    if backend == "redis":
+        return RedisSeenCache(name, ttl=ttl)
+    return LocalSeenCache(name, ttl=ttl, max_keys=int(os.getenv("DEDUP_MAX_KEYS", 100000)))
+
+
+def finding_key(payload, content_hash=False):
+    """Idempotency key of a finding: its id and webhook, plus a hash of the
+    whole payload with content_hash, so that a finding whose content changed
+    is delivered again. None when the payload carries no id.
+
+    """
+    finding_id = payload.get("id")
+    if finding_id is None:
+        return None
+    key = f"{finding_id}|{payload.get('webhook_url')}"
+    if content_hash:
+        key += "|" + hashlib.sha1(jsonlib.dumps(payload)).hexdigest()
+    return key
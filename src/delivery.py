@@ -0,0 +1,232 @@
+import time
+import heapq
+import logging
+import itertools
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT = metrics.gauge("delivery_in_flight", "Deliveries currently running")
+PENDING = metrics.gauge("delivery_pending", "Deliveries waiting for a free slot or for the rate limiter")
+RATE_LIMITED = metrics.counter("delivery_rate_limited_total", "Deliveries rescheduled after a 429")
+OVERFLOWED = metrics.counter(
+    "delivery_overflowed_total", "Deliveries handed back because their webhook had too many waiting already")
+
+# Key under which a handler that sends a payload as several messages records
+# how many were accepted, so that a delivery run again resumes after them.
+SENT_FIELD = "_messages_sent"
+
+
+class Delivery:
+    """A unit of work handed to the delivery engine, together with the channel
+    its messages arrived on so the acks go back to the right place. A
+    coalesced delivery carries the tags of every message it was built from.
+
+    """
+
+    __slots__ = ("channel", "delivery_tags", "handler", "payload", "key", "routing_key", "idempotency_keys",
+                 "priority", "trace", "submitted")
+
+    def __init__(self, channel, delivery_tags, handler, payload, key=None, routing_key=None,
+                 idempotency_keys=(), priority=0, trace=None):
+        self.channel = channel
+        self.delivery_tags = delivery_tags
+        self.handler = handler
+        self.payload = payload
+        self.key = key
+        self.routing_key = routing_key
+        self.idempotency_keys = idempotency_keys
+        self.priority = priority
+        self.trace = trace
+        self.submitted = time.perf_counter()
+
+
+class DeliveryEngine:
+    """Runs message handlers on a thread pool so that slow webhooks never block
+    the IOLoop, with at most max_in_flight handlers running at once. Anything
+    submitted above that cap waits until a slot frees up, highest priority
+    first and in submission order within a priority.
+
+    Completion is reported back on the IOLoop thread through on_done, which is
+    where the caller is expected to ack the delivery.
+
+    With a rate_limiter, deliveries that carry a key (the webhook url) are
+    paced per key: a delivery that has to wait is parked on an IOLoop timer
+    without holding a slot, and one that comes back rate limited is pushed
+    back by its Retry-After and tried again, so a busy webhook never holds up
+    the others.
+
+    With on_overflow as well, at most max_deferred_per_key deliveries may wait
+    on the rate limiter for the same key. Any more are handed to
+    on_overflow(delivery) on the IOLoop instead of being parked, so that one
+    busy webhook can't fill the prefetch window with messages that only wait.
+
+    A handler that returns a result with partial set has sent one message of
+    several and is run again for the next one, after going through the rate
+    limiter like a new delivery.
+
+    With a controller, every handler's run time and result are reported to
+    controller.observe(), and max_in_flight may be changed through set_limit()
+    up to max_workers, the size of the thread pool.
+
+    """
+
+    def __init__(self, ioloop, on_done, max_in_flight=10, rate_limiter=None, controller=None, max_workers=None,
+                 on_overflow=None, max_deferred_per_key=10):
+        self.ioloop = ioloop
+        self.on_done = on_done
+        self.on_overflow = on_overflow
+        self.max_deferred_per_key = max_deferred_per_key
+        self.max_in_flight = max_in_flight
+        self.rate_limiter = rate_limiter
+        self.controller = controller
+        self.max_workers = max(max_workers or max_in_flight, max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="delivery")
+        # A rate limiter that makes network calls (see RedisRateLimiter) is
+        # called from a thread of its own rather than from the IOLoop. One
+        # thread keeps each key's defer() ahead of its next reserve().
+        self._limiter_executor = None
+        if getattr(rate_limiter, "remote", False):
+            self._limiter_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limiter")
+        self._pending = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._deferred = 0
+        self._deferred_keys = Counter()
+        self._idle_callbacks = []
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def saturated(self):
+        return self._in_flight >= self.max_in_flight
+
+    def set_limit(self, max_in_flight):
+        """Change how many handlers may run at once, between 1 and max_workers.
+        Lowering it lets the handlers already running finish.
+
+        """
+        self.max_in_flight = min(max(1, max_in_flight), self.max_workers)
+        self._drain()
+
+    @property
+    def idle(self):
+        return not (self._in_flight or self._pending or self._deferred)
+
+    def when_idle(self, callback):
+        """Call callback on the IOLoop once nothing is running, queued or
+        waiting on the rate limiter, straight away if that is already the case.
+
+        """
+        if self.idle:
+            callback()
+        else:
+            self._idle_callbacks.append(callback)
+
+    def submit(self, delivery):
+        """Queue a delivery and start it straight away if a slot is free.
+        Must be called from the IOLoop thread.
+
+        :param Delivery delivery: The delivery to run
+
+        """
+        if self.rate_limiter is not None and delivery.key:
+            # With deliveries for the key already waiting this one would wait
+            # too, so it is handed back before it takes a rate limiter slot.
+            if self.on_overflow is not None and self._deferred_keys[delivery.key] >= self.max_deferred_per_key:
+                OVERFLOWED.inc()
+                self.on_overflow(delivery)
+                return
+            # Counted as waiting from here, for the cap above and when_idle.
+            self._deferred += 1
+            self._deferred_keys[delivery.key] += 1
+            self._update_gauges()
+            if self._limiter_executor is not None:
+                future = self._limiter_executor.submit(self.rate_limiter.reserve, delivery.key)
+                self.ioloop.add_future(future, functools.partial(self._on_reserved, delivery))
+            else:
+                self._park(delivery, self.rate_limiter.reserve(delivery.key))
+            return
+        self._enqueue(delivery)
+
+    def _on_reserved(self, delivery, future):
+        try:
+            delay = future.result()
+        except Exception:
+            logger.exception('Rate limiter failed, sending delivery %s unpaced', delivery.delivery_tags)
+            delay = 0
+        self._park(delivery, delay)
+
+    def _park(self, delivery, delay):
+        if delay > 0:
+            self.ioloop.call_later(delay, self._enqueue_deferred, delivery)
+        else:
+            self._enqueue_deferred(delivery)
+
+    def _enqueue_deferred(self, delivery):
+        self._deferred -= 1
+        self._deferred_keys[delivery.key] -= 1
+        if not self._deferred_keys[delivery.key]:
+            del self._deferred_keys[delivery.key]
+        self._enqueue(delivery)
+
+    def _enqueue(self, delivery):
+        heapq.heappush(self._pending, (-delivery.priority, next(self._sequence), delivery))
+        self._drain()
+
+    def _drain(self):
+        while self._pending and self._in_flight < self.max_in_flight:
+            delivery = heapq.heappop(self._pending)[2]
+            self._in_flight += 1
+            self._update_gauges()
+            future = self._executor.submit(self._run, delivery)
+            self.ioloop.add_future(future, functools.partial(self._on_complete, delivery, time.perf_counter()))
+
+    @staticmethod
+    def _run(delivery):
+        trace = delivery.trace
+        if trace is None:
+            return delivery.handler(delivery.payload)
+        # Time spent waiting for a slot, including any rate limiter delay.
+        trace.record("queued", delivery.submitted)
+        with tracing.activate(trace), trace.span("handle"):
+            return delivery.handler(delivery.payload)
+
+    def _update_gauges(self):
+        IN_FLIGHT.set(self._in_flight)
+        PENDING.set(len(self._pending) + self._deferred)
+
+    def _on_complete(self, delivery, started, future):
+        self._in_flight -= 1
+        self._update_gauges()
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception('Handler failed for delivery %s', delivery.delivery_tags)
+            result = False
+        if self.controller is not None:
+            self.controller.observe(time.perf_counter() - started, result)
+        if getattr(result, 'rate_limited', False) and self.rate_limiter is not None and delivery.key:
+            logger.info('Delivery %s rate limited, rescheduling', delivery.delivery_tags)
+            RATE_LIMITED.inc()
+            if self._limiter_executor is not None:
+                self._limiter_executor.submit(self.rate_limiter.defer, delivery.key, result.retry_after)
+            else:
+                self.rate_limiter.defer(delivery.key, result.retry_after)
+            self.submit(delivery)
+        elif getattr(result, 'partial', False):
+            self.submit(delivery)
+        else:
+            self.on_done(delivery, result)
+        self._drain()
+        if self.idle:
+            callbacks, self._idle_callbacks = self._idle_callbacks, []
+            for callback in callbacks:
+                callback()
@@ -0,0 +1,100 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("session", "last_used", "active")
+
+    def __init__(self, session):
+        self.session = session
+        self.last_used = time.monotonic()
+        self.active = 0
+
+
+class SessionPool:
+    """Keep-alive requests sessions shared between threads, one per scheme+host.
+
+    Each host gets an HTTPAdapter holding at most pool_maxsize idle sockets.
+    Hosts that have not been used for idle_timeout seconds are closed, and the
+    least recently used idle host is closed whenever keeping it would let the
+    pool hold more than max_total sockets. max_total also caps the number of
+    requests running at once across all hosts.
+
+    """
+
+    def __init__(self, pool_maxsize=10, idle_timeout=90, max_total=100):
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self.max_total = max_total
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_total)
+
+    @staticmethod
+    def key_for(url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.netloc
+
+    def post(self, url, **kwargs):
+        """Same as requests.post, but over a pooled keep-alive connection."""
+        with self._slots:
+            entry = self._checkout(url)
+            try:
+                return entry.session.post(url, **kwargs)
+            finally:
+                self._checkin(entry)
+
+    def _checkout(self, url):
+        key = self.key_for(url)
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(self._new_session())
+                self._entries[key] = entry
+                self._evict_over_capacity(keep=key)
+            self._entries.move_to_end(key)
+            entry.active += 1
+            return entry
+
+    def _checkin(self, entry):
+        with self._lock:
+            entry.active -= 1
+            entry.last_used = time.monotonic()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for key, entry in list(self._entries.items()):
+            if not entry.active and entry.last_used < deadline:
+                self._close(key)
+
+    def _evict_over_capacity(self, keep):
+        for key, entry in list(self._entries.items()):
+            if len(self._entries) * self.pool_maxsize <= self.max_total:
+                break
+            if key != keep and not entry.active:
+                self._close(key)
+
+    def _close(self, key):
+        logger.info('Closing idle HTTP connections to %s://%s', *key)
+        self._entries.pop(key).session.close()
+
+    def close(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._close(key)
@@ -0,0 +1,28 @@
+import os
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Picked once at startup: orjson when it is installed, the stdlib otherwise.
+# Set JSON_BACKEND=json to force the stdlib.
+BACKEND = os.getenv("JSON_BACKEND", "orjson" if orjson is not None else "json")
+
+if BACKEND == "orjson":
+    if orjson is None:
+        raise RuntimeError("JSON_BACKEND=orjson but orjson is not installed, run: pip install orjson")
+
+    loads = orjson.loads
+    dumps = orjson.dumps
+elif BACKEND == "json":
+    def loads(data):
+        """Decode JSON straight from bytes, the stdlib detects the encoding."""
+        return json.loads(data)
+
+    def dumps(obj):
+        """Encode obj to UTF-8 JSON bytes."""
+        return json.dumps(obj).encode("utf-8")
+else:
+    raise RuntimeError(f"Unknown JSON_BACKEND {BACKEND!r}, expected orjson or json")
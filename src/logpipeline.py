@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+
+_listener = None
+_listener_pid = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """LOG_FORMAT followed by the record's fields, if any, as key=value pairs."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the record before queueing it, which is
+    # exactly the work we want off the calling thread. The listener lives in
+    # the same process, so the record can be queued as is.
+    def prepare(self, record):
+        return record
+
+
+class BatchWriter:
+    """Drains log records from a queue on a background thread and writes them
+    to stream in batches of up to batch_size records, with one write and one
+    flush per batch. A lone record waits at most flush_interval seconds.
+
+    """
+
+    _STOP = object()
+
+    def __init__(self, records, stream, formatter, batch_size=256, flush_interval=0.2):
+        self.records = records
+        self.stream = stream
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Write out everything queued so far and stop the thread."""
+        self.records.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            record = self.records.get()
+            # The interval runs from the first record of the batch, so a
+            # steady trickle of records can't hold the batch back.
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                while True:
+                    if record is self._STOP:
+                        stopping = True
+                        break
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        break
+                    record = self.records.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                pass
+            self._write(batch)
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                lines.append(f"Unformattable log record {record.msg!r} {record.args!r}")
+        if lines:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+
+
+class MessageLogger:
+    """Per-message log lines, emitted for a sample_rate fraction of messages.
+    The sampling and level checks come first, so a message that is not logged
+    costs neither a LogRecord nor any formatting. Keyword arguments become
+    the record's structured fields.
+
+    """
+
+    def __init__(self, name, sample_rate=None):
+        self.logger = logging.getLogger(name)
+        if sample_rate is None:
+            sample_rate = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+        self.sample_rate = sample_rate
+
+    def info(self, msg, **fields):
+        if self.sample_rate <= 0 or not self.logger.isEnabledFor(logging.INFO):
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        self.logger.info(msg, extra={"fields": fields}, stacklevel=2)
+
+
+def configure(level=None, stream=None, batch_size=None, flush_interval=None, background=True):
+    """Route every log record through a queue to a BatchWriter thread, so that
+    logging never writes to the terminal from the caller's thread. Replaces
+    any handlers already on the root logger. Call it again after a fork, the
+    writer thread does not survive one.
+
+    With background=False records are written by the caller instead, for a
+    process that forks: a writer thread could hold the stream's lock at the
+    moment of the fork and leave it locked forever in the child.
+
+    Defaults come from LOG_LEVEL, LOG_BATCH_SIZE and LOG_FLUSH_INTERVAL.
+
+    """
+    global _listener, _listener_pid
+    previous = _listener if _listener_pid == os.getpid() else None
+    formatter = StructuredFormatter(LOG_FORMAT)
+    if background:
+        records = queue.SimpleQueue()
+        _listener = BatchWriter(
+            records,
+            stream or sys.stderr,
+            formatter,
+            batch_size=batch_size or int(os.getenv("LOG_BATCH_SIZE", 256)),
+            flush_interval=flush_interval or float(os.getenv("LOG_FLUSH_INTERVAL", 0.2)),
+        )
+        _listener.start()
+        handler = _DeferredQueueHandler(records)
+    else:
+        _listener = None
+        handler = logging.StreamHandler(stream or sys.stderr)
+        handler.setFormatter(formatter)
+    _listener_pid = os.getpid()
+
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+    if previous is not None:
+        previous.stop()
+    return _listener
+
+
+def shutdown():
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
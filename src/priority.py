@@ -0,0 +1,20 @@
+# AMQP message priority of each finding severity, highest first. Queues are
+# declared with x-max-priority=MAX_PRIORITY; RabbitMQ recommends keeping it
+# small since every level costs memory and CPU on the broker.
+SEVERITY_PRIORITIES = {
+    "critical": 9,
+    "high": 7,
+    "medium": 5,
+    "low": 3,
+    "informational": 1,
+    "info": 1,
+}
+
+MAX_PRIORITY = max(SEVERITY_PRIORITIES.values())
+
+
+def severity_priority(severity_type):
+    """Priority for a finding's severity_type, 0 when it is missing or unknown."""
+    if not severity_type:
+        return 0
+    return SEVERITY_PRIORITIES.get(str(severity_type).lower(), 0)
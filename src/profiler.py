@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import signal
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Innermost Python frames of a thread that is blocked waiting for work. Such
+# samples are dropped so that idle threads don't drown out the hot path.
+IDLE_FRAMES = frozenset((
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+))
+
+
+class SamplingProfiler:
+    """Statistical profiler for a running process: a background thread takes
+    the stack of every other thread each interval seconds and counts them.
+    Nothing is hooked into the code being profiled, so the overhead is one
+    stack walk per thread per sample and the profiler can be switched on and
+    off at any time. Threads blocked waiting for work are left out.
+
+    Stacks are dumped in the folded format (one "outer;...;inner count" line
+    per stack) read by flamegraph.pl and speedscope.
+
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = Counter()
+        self._samples = 0
+        self._thread = None
+        self._running = threading.Event()
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def start(self):
+        if self.running:
+            return
+        self._stacks = Counter()
+        self._samples = 0
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while self._running.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[";".join(reversed(stack))] += 1
+            self._samples += 1
+            time.sleep(self.interval)
+
+    def dump(self, path, top=20):
+        """Write the folded stacks to path and log the functions most often
+        on top of a stack.
+
+        """
+        stacks = self._stacks.copy()
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        own = Counter()
+        for stack, count in stacks.items():
+            own[stack.rsplit(";", 1)[-1]] += count
+        total = sum(own.values()) or 1
+        lines = [f"{count / total:6.1%} {frame}" for frame, count in own.most_common(top)]
+        logger.info('Profile of %s samples written to %s, hottest frames:\n%s', self._samples, path, "\n".join(lines))
+
+
+_profiler = SamplingProfiler()
+
+
+def _dump_path():
+    directory = os.getenv("PROFILE_DIR", tempfile.gettempdir())
+    return os.path.join(directory, f"consumer-profile-{os.getpid()}-{int(time.time())}.folded")
+
+
+def _stop_and_dump():
+    _profiler.stop()
+    try:
+        _profiler.dump(_dump_path())
+    except OSError as e:
+        logger.error('Could not write profile: %s', e)
+
+
+def toggle(*_args):
+    """Start profiling, or stop and dump the profile if it is running. The
+    dump happens on its own thread since this is called from a signal handler.
+
+    """
+    if _profiler.running:
+        threading.Thread(target=_stop_and_dump, name="profiler-dump", daemon=True).start()
+    else:
+        logger.info('Profiling started, send the same signal again to stop')
+        _profiler.start()
+
+
+def install(signum=signal.SIGUSR2):
+    """Toggle the profiler on signum, e.g. kill -USR2 <worker pid>, and with
+    PROFILE_SECONDS set, profile the first that many seconds of the process.
+    PROFILE_INTERVAL sets the sampling interval.
+
+    """
+    _profiler.interval = float(os.getenv("PROFILE_INTERVAL", 0.005))
+    signal.signal(signum, toggle)
+    seconds = float(os.getenv("PROFILE_SECONDS", 0))
+    if seconds > 0:
+        _profiler.start()
+        timer = threading.Timer(seconds, _stop_and_dump)
+        timer.daemon = True
+        timer.start()
@@ -0,0 +1,100 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from redis_client import get_redis
+
+
+class RateLimiter:
+    """In-process per-key token bucket, kept in GCRA form so that each key only
+    needs a single timestamp: the theoretical arrival time of the next send.
+
+    reserve() always takes a slot and returns how long the caller must wait
+    before using it, so a burst of messages for one webhook is spread out at
+    the configured rate instead of all retrying at once. defer() pushes a key
+    back, e.g. after Slack answered 429 with a Retry-After header.
+
+    """
+
+    def __init__(self, rate=1.0, burst=1, max_keys=10000):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._tat = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, key):
+        """Take the next send slot for key.
+
+        :param str key: The webhook url
+        :return: seconds to wait before sending, 0 to send now
+        :rtype: float
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            tat = max(self._tat.pop(key, now), now)
+            self._tat[key] = tat + self.interval
+            if len(self._tat) > self.max_keys:
+                self._tat.popitem(last=False)
+        return max(0.0, tat - now - (self.burst - 1) * self.interval)
+
+    def defer(self, key, seconds):
+        """Hold every send for key for at least the given number of seconds."""
+        until = time.monotonic() + seconds + (self.burst - 1) * self.interval
+        with self._lock:
+            self._tat[key] = max(self._tat.get(key, until), until)
+            self._tat.move_to_end(key)
+
+
+class RedisRateLimiter:
+    """Same contract as RateLimiter, with the state in Redis so that every
+    consumer process paces a webhook against the same budget.
+
+    The calls are single round trips to Redis. remote tells DeliveryEngine
+    to make them away from the IOLoop thread.
+
+    """
+
+    remote = True
+
+    RESERVE = """
+    local now = tonumber(ARGV[1])
+    local interval = tonumber(ARGV[2])
+    local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now)
+    local new_tat = tat + interval
+    redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000) + 1000)
+    return tostring(math.max(0, tat - now - tonumber(ARGV[3])))
+    """
+
+    DEFER = """
+    local now = tonumber(ARGV[1])
+    local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or 0), now + tonumber(ARGV[2]) + tonumber(ARGV[3]))
+    redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+    return 1
+    """
+
+    def __init__(self, rate=1.0, burst=1, client=None, prefix="slack:ratelimit:"):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self.prefix = prefix
+        self._redis = client or get_redis()
+        self._reserve = self._redis.register_script(self.RESERVE)
+        self._defer = self._redis.register_script(self.DEFER)
+
+    def reserve(self, key):
+        delay = self._reserve(keys=[self.prefix + key], args=[time.time(), self.interval, (self.burst - 1) * self.interval])
+        return float(delay)
+
+    def defer(self, key, seconds):
+        self._defer(keys=[self.prefix + key], args=[time.time(), seconds, (self.burst - 1) * self.interval])
+
+
+def rate_limiter_from_env():
+    """Build the rate limiter selected by RATE_LIMIT_BACKEND (memory or redis)."""
+    rate = float(os.getenv("SLACK_RATE_LIMIT", 1.0))
+    burst = int(os.getenv("SLACK_RATE_BURST", 1))
+    if os.getenv("RATE_LIMIT_BACKEND", "memory") == "redis":
+        return RedisRateLimiter(rate=rate, burst=burst)
+    return RateLimiter(rate=rate, burst=burst)
@@ -0,0 +1,17 @@
+import os
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def get_redis(url=None):
+    """Return a Redis client for the optional Redis-backed stores.
+
+    :param str url: Redis URL, defaults to the REDIS_URL environment variable
+
+    """
+    if redis is None:
+        raise RuntimeError("The redis package is required for the Redis backends, run: pip install redis")
+    return redis.Redis.from_url(url or os.getenv("REDIS_URL", "redis://localhost:6379/0"))
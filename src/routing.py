@@ -0,0 +1,151 @@
+import threading
+
+
+class _Node:
+    __slots__ = ("children", "star", "hash", "is_hash", "handlers")
+
+    def __init__(self, is_hash=False):
+        self.children = {}
+        self.star = None
+        self.hash = None
+        self.is_hash = is_hash
+        self.handlers = []
+
+
+class HandlerRegistry:
+    """Message handlers registered by AMQP topic pattern: words separated by
+    dots, where * matches exactly one word and # zero or more.
+
+    Patterns are kept in a trie of their words. Matching walks it once per
+    word of the routing key, following literal, * and # edges together, so
+    its cost depends on the key and not on how many patterns are registered.
+    resolve() additionally caches the handler for each routing key seen.
+
+    """
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._root = _Node()
+        self._patterns = []
+        self._order = {}
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def register(self, pattern, handler=None):
+        """Register handler for pattern. Without a handler, returns a
+        decorator that registers the function it decorates.
+
+        """
+        if handler is None:
+            return lambda func: self.register(pattern, func)
+        with self._lock:
+            node = self._root
+            for word in pattern.split("."):
+                if word == "#":
+                    node.hash = node.hash or _Node(is_hash=True)
+                    node = node.hash
+                elif word == "*":
+                    node.star = node.star or _Node()
+                    node = node.star
+                else:
+                    node = node.children.setdefault(word, _Node())
+            node.handlers.append(handler)
+            self._order.setdefault(handler, len(self._order))
+            if pattern not in self._patterns:
+                self._patterns.append(pattern)
+            self._cache.clear()
+        return handler
+
+    def patterns(self):
+        """Every registered pattern, in registration order, to bind with."""
+        return list(self._patterns)
+
+    def match(self, routing_key):
+        """Every handler whose pattern matches routing_key, in registration
+        order, each handler once.
+
+        """
+        states = self._closure([self._root])
+        for word in routing_key.split("."):
+            following = []
+            for node in states:
+                child = node.children.get(word)
+                if child is not None:
+                    following.append(child)
+                if node.star is not None:
+                    following.append(node.star)
+                if node.is_hash:
+                    following.append(node)
+            if not following:
+                return []
+            states = self._closure(following)
+        handlers = {handler for node in states for handler in node.handlers}
+        return sorted(handlers, key=self._order.__getitem__)
+
+    @staticmethod
+    def _closure(nodes):
+        # A # may match zero words, so being at a node also means being at
+        # the # below it.
+        states = {}
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if id(node) in states:
+                continue
+            states[id(node)] = node
+            if node.hash is not None:
+                stack.append(node.hash)
+        return states.values()
+
+    def resolve(self, routing_key):
+        """The callable to deliver a message with routing_key to, or None if
+        no pattern matches. Several matching handlers are run one after the
+        other by a fan-out that stops at the first failure, so a retry goes to
+        all of them again, or at the first partial result, to be run again.
+
+        """
+        try:
+            return self._cache[routing_key]
+        except KeyError:
+            pass
+        handlers = self.match(routing_key)
+        if not handlers:
+            resolved = None
+        elif len(handlers) == 1:
+            resolved = handlers[0]
+        else:
+            resolved = _fan_out(handlers)
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[routing_key] = resolved
+        return resolved
+
+    def __contains__(self, routing_key):
+        return self.resolve(routing_key) is not None
+
+
+def _fan_out(handlers):
+    def run_all(payload):
+        result = None
+        for handler in handlers:
+            result = handler(payload)
+            if not result or getattr(result, "partial", False):
+                break
+        return result
+    return run_all
+
+
+# Handlers for one message at a time, and handlers able to deliver several
+# payloads for the same webhook at once, used instead when coalescing.
+FUNC_HANDLERS = HandlerRegistry()
+BATCH_HANDLERS = HandlerRegistry()
+
+
+def handler(pattern):
+    """Decorator registering a message handler for a topic pattern."""
+    return FUNC_HANDLERS.register(pattern)
+
+
+def batch_handler(pattern):
+    """Decorator registering a batch handler for a topic pattern."""
+    return BATCH_HANDLERS.register(pattern)
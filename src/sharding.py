@@ -0,0 +1,12 @@
+# Sharding by webhook through RabbitMQ's consistent-hash exchange, which
+# needs the rabbitmq_consistent_hash_exchange plugin enabled on the broker.
+# The hash exchange is bound to the topic exchange findings are published to
+# and hashes SHARD_HEADER, so every finding for a webhook lands in the same
+# shard queue and is delivered, ordered and paced by a single worker.
+SHARD_EXCHANGE_TYPE = "x-consistent-hash"
+SHARD_HEADER = "x-shard-key"
+
+
+def shard_key(payload):
+    """Value of SHARD_HEADER for a finding: its webhook url."""
+    return payload.get("webhook_url")
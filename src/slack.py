@@ -1,44 +1,194 @@
-import json
+import os
+import time
+import jsonlib
+import metrics
 import requests
 import logging
+import tracing
 from typing import Any
-from templates import SlackTemplateBuilder
+from templates import SlackTemplateBuilder, CompiledSlackTemplate, iter_combined_templates
+from http_pool import SessionPool
+from breaker import circuit_breaker_from_env, is_permanent
+from logpipeline import MessageLogger
+from routing import handler, batch_handler
+from delivery import SENT_FIELD
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+message_log = MessageLogger(__name__ + ".messages")
+
+# Every webhook is on hooks.slack.com, so its pool is the one all deliveries
+# share: by default it keeps a socket for every delivery a worker may have in
+# flight, up to MAX_IN_FLIGHT_CEILING when the limit is adaptive.
+max_in_flight = max(int(os.getenv("MAX_IN_FLIGHT", 10)), int(os.getenv("MAX_IN_FLIGHT_CEILING", 0)))
+session_pool = SessionPool(
+    pool_maxsize=int(os.getenv("SLACK_POOL_MAXSIZE", 0)) or max_in_flight,
+    idle_timeout=float(os.getenv("SLACK_POOL_IDLE_TIMEOUT", 90)),
+    max_total=int(os.getenv("SLACK_POOL_MAX_TOTAL", 0)) or max(100, max_in_flight),
+)
+
+circuit_breaker = circuit_breaker_from_env()
+
+compiled_template = CompiledSlackTemplate()
+
+REQUEST_SECONDS = metrics.histogram(
+    "slack_request_seconds", "Slack webhook POST latency by response status", ["status"])
+RENDER_SECONDS = metrics.histogram(
+    "slack_render_seconds", "Time spent rendering one Slack message",
+    buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05))
+
+
+class DeliveryResult:
+    """Outcome of a webhook POST. Truthy only when Slack accepted the message,
+    so it can still be used where a plain success flag was expected.
+    permanent marks a failure that no retry will fix, partial an accepted
+    message that was not the last one of its delivery.
+
+    """
+
+    __slots__ = ("success", "status_code", "retry_after", "error", "permanent", "partial")
+
+    def __init__(self, success, status_code=None, retry_after=None, error=None, permanent=False):
+        self.success = success
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.error = error
+        self.permanent = permanent
+        self.partial = False
+
+    def __bool__(self):
+        return self.success
+
+    @property
+    def rate_limited(self):
+        return self.status_code == 429
+
+
+def parse_retry_after(value, default=1.0):
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
 
 
 class SlackBot:
-    def __init__(self, webhook_url, timeout=15, **kwargs):
+    def __init__(self, webhook_url, timeout=15, pool=None, breaker=None, **kwargs):
         self.webhook_url = webhook_url
         self.timeout = timeout
+        self.pool = pool or session_pool
+        self.breaker = breaker or circuit_breaker
         self.headers = {
             'Content-Type': 'application/json',
         }
 
     def send_message(self, message: Any):
-        success = False
+        # Webhooks known to be dead or failing are refused without a request,
+        # so they can't tie up delivery slots for the length of a timeout.
+        refused = self.breaker.allow(self.webhook_url)
+        if refused:
+            logger.warning(f'Not sending to Slack, circuit {refused}.')
+            return DeliveryResult(False, error=f'circuit {refused}', permanent=refused == 'dead')
+        result = self._post(message)
+        self.breaker.record(self.webhook_url, result.status_code, result.error, success=result.success)
+        if not result and is_permanent(result.status_code, result.error):
+            result.permanent = True
+        return result
+
+    def _post(self, message):
+        # Already serialized messages (see CompiledSlackTemplate) go out as is,
+        # anything else is encoded once here rather than by requests.
+        if not isinstance(message, bytes):
+            with tracing.span("serialize"):
+                message = jsonlib.dumps(message)
 
+        started = time.perf_counter()
         try:
-            requests.post(
-                self.webhook_url,
-                headers=self.headers,
-                json=message,
-                timeout=self.timeout
-            )
+            with tracing.span("send"):
+                response = self.pool.post(
+                    self.webhook_url,
+                    headers=self.headers,
+                    data=message,
+                    timeout=self.timeout
+                )
         except requests.Timeout:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, status='timeout')
             logger.error('Timeout occurred when trying to send message to Slack.')
+            return DeliveryResult(False, error='timeout')
         except requests.RequestException as e:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, status='error')
             logger.error(f'Error occurred when communicating with Slack: {e}.')
-        else:
-            success = True
-            logger.info('Successfully sent message to Slack.')
+            return DeliveryResult(False, error=str(e))
+        REQUEST_SECONDS.observe(time.perf_counter() - started, status=response.status_code)
+
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            logger.warning(f'Rate limited by Slack, retrying after {retry_after}s.')
+            return DeliveryResult(False, response.status_code, retry_after=retry_after)
+        if not response.ok:
+            logger.error(f'Slack rejected message with {response.status_code}: {response.text}.')
+            return DeliveryResult(False, response.status_code, error=response.text)
+
+        message_log.info('sent', status=response.status_code, bytes=len(message))
+        return DeliveryResult(True, response.status_code)
+
+def timed_render(messages):
+    """Pass messages through, recording how long each took to render."""
+    iterator = iter(messages)
+    while True:
+        started = time.perf_counter()
+        try:
+            message = next(iterator)
+        except StopIteration:
+            return
+        record_render(started)
+        yield message
 
-        return success
 
+def record_render(started):
+    RENDER_SECONDS.observe(time.perf_counter() - started)
+    trace = tracing.current()
+    if trace is not None:
+        trace.record("render", started)
 
+
+@handler("slack.observed")
 def slack_event_handler(payload):
-    webhook_url = payload.pop("webhook_url")
-    template_builder = SlackTemplateBuilder(payload)
-    bot = SlackBot(webhook_url=webhook_url)
-    bot.send_message(template_builder.build_template())
+    """Send a finding. One too large for a single message is sent one chunk
+    per call: the number of chunks accepted is kept in the payload and a
+    partial result has the delivery engine run it again, paced by the rate
+    limiter, for the next chunk, so a 429 or a retry never repeats a chunk.
+
+    """
+    sent = payload.get(SENT_FIELD, 0)
+    builder = SlackTemplateBuilder(payload)
+    started = time.perf_counter()
+    blocks = compiled_template.message_blocks(builder, sent)
+    record_render(started)
+    with tracing.span("serialize"):
+        message = compiled_template.serialize(blocks)
+    result = SlackBot(webhook_url=payload["webhook_url"]).send_message(message)
+    if result and sent + 1 < compiled_template.count_messages(builder):
+        payload[SENT_FIELD] = sent + 1
+        result.partial = True
+    return result
+
+
+@batch_handler("slack.observed")
+def slack_batch_handler(payloads):
+    """Deliver several payloads for the same webhook as combined messages,
+    one message per call like slack_event_handler. Payloads are dropped from
+    the list as soon as the message carrying them is accepted, so a batch
+    that is run again picks up where it stopped.
+
+    """
+    if not SlackTemplateBuilder(payloads[0]).fits_one_message():
+        result = slack_event_handler(payloads[0])
+        if result and not result.partial:
+            del payloads[:1]
+            result.partial = bool(payloads)
+        return result
+    count, message = next(timed_render(iter_combined_templates(list(payloads))))
+    result = SlackBot(webhook_url=payloads[0]["webhook_url"]).send_message(message)
+    if result:
+        del payloads[:count]
+        result.partial = bool(payloads)
+    return result
@@ -0,0 +1,118 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import jsonlib
+from redis_client import get_redis
+
+
+class LocalStateStore:
+    """In-process counters and hashes with a TTL, capped at max_keys entries
+    by evicting the least recently used key. Every write pushes the key's
+    expiry back by ttl seconds.
+
+    """
+
+    def __init__(self, ttl=86400, max_keys=100000):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            value = (self._get(key) or 0) + 1
+            self._put(key, value)
+        return value
+
+    def hget(self, name, field):
+        with self._lock:
+            return (self._get(name) or {}).get(field)
+
+    def hset(self, name, field, value):
+        with self._lock:
+            fields = self._get(name) or {}
+            fields[field] = value
+            self._put(name, fields)
+
+    def hsetnx(self, name, field, value):
+        with self._lock:
+            fields = self._get(name) or {}
+            if field in fields:
+                return False
+            fields[field] = value
+            self._put(name, fields)
+        return True
+
+    def hdel(self, name, field):
+        with self._lock:
+            (self._get(name) or {}).pop(field, None)
+
+
+class RedisStateStore:
+    """Same contract as LocalStateStore, shared by every web worker through
+    Redis. Counters use INCR and hashes HSET/HSETNX, so concurrent updates
+    from several processes never race. Values are stored as JSON.
+
+    """
+
+    def __init__(self, ttl=86400, client=None, prefix="state:"):
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = client or get_redis()
+
+    def incr(self, key):
+        key = self.prefix + key
+        pipe = self._redis.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, self.ttl)
+        return pipe.execute()[0]
+
+    def hget(self, name, field):
+        value = self._redis.hget(self.prefix + name, field)
+        return None if value is None else jsonlib.loads(value)
+
+    def hset(self, name, field, value):
+        name = self.prefix + name
+        pipe = self._redis.pipeline()
+        pipe.hset(name, field, jsonlib.dumps(value))
+        pipe.expire(name, self.ttl)
+        pipe.execute()
+
+    def hsetnx(self, name, field, value):
+        name = self.prefix + name
+        pipe = self._redis.pipeline()
+        pipe.hsetnx(name, field, jsonlib.dumps(value))
+        pipe.expire(name, self.ttl)
+        return bool(pipe.execute()[0])
+
+    def hdel(self, name, field):
+        self._redis.hdel(self.prefix + name, field)
+
+
+def state_store_from_env():
+    """Build the store selected by STATE_BACKEND: memory (default) or redis,
+    with STATE_TTL and STATE_MAX_KEYS.
+
+    """
+    ttl = int(os.getenv("STATE_TTL", 86400))
+    if os.getenv("STATE_BACKEND", "memory") == "redis":
+        return RedisStateStore(ttl=ttl)
+    return LocalStateStore(ttl=ttl, max_keys=int(os.getenv("STATE_MAX_KEYS", 100000)))
@@ -0,0 +1,114 @@
+import time
+import signal
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_main(target, index):
+    # CTRL-C in a terminal reaches the whole process group; let the supervisor
+    # alone decide when workers stop. SIGTERM ends the worker outright until
+    # target installs a handler that drains it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(index)
+
+
+class Supervisor:
+    """Forks worker_count processes that each run target(index), restarts any
+    worker that exits while we are not shutting down, and on SIGTERM or SIGINT
+    sends SIGTERM to every worker and waits up to shutdown_timeout seconds for
+    them to drain before killing what is left.
+
+    target is expected to handle SIGTERM itself by draining and returning.
+
+    A worker that dies within min_uptime seconds of being started is restarted
+    with an exponential backoff, up to max_restart_delay seconds, so a crash
+    loop (e.g. the broker being down) doesn't spin.
+
+    """
+
+    def __init__(self, target, worker_count, shutdown_timeout=30, restart_delay=1.0,
+                 max_restart_delay=30.0, min_uptime=10.0):
+        self.target = target
+        self.worker_count = worker_count
+        self.shutdown_timeout = shutdown_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self._context = multiprocessing.get_context("fork")
+        self._workers = {}
+        self._started = {}
+        self._delays = {}
+        self._restart_at = {}
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        logger.info('Starting %s workers', self.worker_count)
+        for index in range(self.worker_count):
+            self._spawn(index)
+
+        while not self._stopping:
+            sentinels = [worker.sentinel for worker in self._workers.values()]
+            wait(sentinels, timeout=1.0)
+            self._reap()
+            self._restart_due()
+
+        self._shutdown()
+
+    def _spawn(self, index):
+        worker = self._context.Process(
+            target=_worker_main,
+            args=(self.target, index),
+            name=f"consumer-{index}",
+        )
+        worker.start()
+        self._workers[index] = worker
+        self._started[index] = time.monotonic()
+        logger.info('Started worker %s (pid %s)', index, worker.pid)
+
+    def _reap(self):
+        for index, worker in list(self._workers.items()):
+            if worker.is_alive():
+                continue
+            worker.join()
+            del self._workers[index]
+            if self._stopping:
+                continue
+            if time.monotonic() - self._started[index] < self.min_uptime:
+                delay = min(self._delays.get(index, self.restart_delay / 2) * 2, self.max_restart_delay)
+            else:
+                delay = self.restart_delay
+            self._delays[index] = delay
+            self._restart_at[index] = time.monotonic() + delay
+            logger.warning('Worker %s exited with code %s, restarting in %.1fs', index, worker.exitcode, delay)
+
+    def _restart_due(self):
+        now = time.monotonic()
+        for index, restart_at in list(self._restart_at.items()):
+            if restart_at <= now and not self._stopping:
+                del self._restart_at[index]
+                self._spawn(index)
+
+    def _on_signal(self, signum, _frame):
+        if self._stopping:
+            return
+        logger.info('Received signal %s, stopping workers', signum)
+        self._stopping = True
+        for worker in self._workers.values():
+            if worker.is_alive():
+                worker.terminate()
+
+    def _shutdown(self):
+        deadline = time.monotonic() + self.shutdown_timeout
+        for index, worker in self._workers.items():
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                logger.warning('Worker %s did not stop in time, killing it', index)
+                worker.kill()
+                worker.join()
+        logger.info('All workers stopped')
@@ -1,3 +1,13 @@
+import re
+import json
+from json.encoder import encode_basestring_ascii
+
+# Slack rejects messages with more blocks than this.
+MAX_BLOCKS = 50
+# Most resource items that fit in a message next to the divider and buttons.
+ITEMS_PER_MESSAGE = MAX_BLOCKS - 2
+
+
 class SlackTemplateBuilder:
 
     def __init__(self, payload):
@@ -13,11 +23,7 @@ class SlackTemplateBuilder:
         title = self.build_title()
         resource_details = self.build_resource_details()
 
-        resource_list = []
-        for item in self.resource_items:
-            apply_val = "apply-" + item.get("id")
-            not_apply_val = "not-apply-" + item.get("id")
-            resource_list.append(self.build_resource_item(item.get("name"), apply_val, not_apply_val))
+        resource_list = [self.build_resource(item) for item in self.resource_items]
 
         button = self.build_approve_button()
 
@@ -29,6 +35,39 @@ class SlackTemplateBuilder:
         template.append(button)
         return {"blocks": template}
 
+    def fits_one_message(self):
+        return len(self.resource_items) + 5 <= MAX_BLOCKS
+
+    def iter_templates(self, items_per_message=ITEMS_PER_MESSAGE):
+        """Yield the finding as a sequence of messages that each fit within
+        Slack's block limit: the single build_template() message when it
+        fits, otherwise a header message followed by continuation messages
+        of up to items_per_message resource items, the last of which carries
+        the buttons. Items are rendered as they are consumed, so memory stays
+        bounded by one message whatever the number of items.
+
+        """
+        if self.fits_one_message():
+            yield self.build_template()
+            return
+
+        items_per_message = min(items_per_message, ITEMS_PER_MESSAGE)
+        yield {"blocks": [self.build_title(), self.build_resource_details(), self.build_divider()]}
+        chunk = []
+        for item in self.resource_items:
+            chunk.append(self.build_resource(item))
+            if len(chunk) == items_per_message:
+                yield {"blocks": chunk}
+                chunk = []
+        chunk.append(self.build_divider())
+        chunk.append(self.build_approve_button())
+        yield {"blocks": chunk}
+
+    def build_resource(self, item):
+        apply_val = "apply-" + item.get("id")
+        not_apply_val = "not-apply-" + item.get("id")
+        return self.build_resource_item(item.get("name"), apply_val, not_apply_val)
+
     @staticmethod
     def build_divider():
         return {
@@ -140,3 +179,168 @@ class SlackTemplateBuilder:
                 }
             ]
         }
+
+
+def iter_combined_templates(payloads, max_blocks=MAX_BLOCKS):
+    """Render several findings for the same webhook as few messages as
+    possible, packing whole findings into each message without going over
+    max_blocks. A finding that does not fit in one message on its own is
+    streamed through SlackTemplateBuilder.iter_templates instead.
+
+    Yields (count, message) pairs, where count is how many of the payloads,
+    in order, are complete once the message is sent.
+
+    """
+    blocks = []
+    count = 0
+    for payload in payloads:
+        builder = SlackTemplateBuilder(payload)
+        if not builder.fits_one_message():
+            if blocks:
+                yield count, {"blocks": blocks}
+                blocks = []
+                count = 0
+            previous = None
+            for message in builder.iter_templates():
+                if previous is not None:
+                    yield 0, previous
+                previous = message
+            yield 1, previous
+            continue
+        finding = builder.build_template()["blocks"]
+        if blocks and len(blocks) + len(finding) > max_blocks:
+            yield count, {"blocks": blocks}
+            blocks = []
+            count = 0
+        blocks.extend(finding)
+        count += 1
+    if blocks:
+        yield count, {"blocks": blocks}
+
+
+class CompiledSlackTemplate:
+    """Renders exactly the bytes of json.dumps(builder.build_template()), but
+    without building the block tree per message.
+
+    Every block is rendered and serialized once, up front, with marker strings
+    in place of the dynamic text. The serialized block is then cut at the
+    markers, so rendering a message is only a matter of JSON escaping the
+    dynamic strings and joining them with the precompiled pieces. JSON string
+    escaping works character by character, so escaping a value on its own and
+    splicing it into the middle of an already escaped string gives the same
+    result as escaping the whole string.
+
+    """
+
+    SLOT = re.compile(r"@@SLOT\d+@@")
+
+    def __init__(self):
+        builder = SlackTemplateBuilder({
+            "title": self.marker(0),
+            "description": self.marker(0),
+            "severity_type": self.marker(1),
+            "compliance": self.marker(2),
+            "resource_type": self.marker(3),
+        })
+        self.title = self._compile(builder.build_title(), 1)
+        self.details = self._compile(builder.build_resource_details(), 4)
+        self.item = self._compile(builder.build_resource_item(self.marker(0), self.marker(1), self.marker(2)), 3)
+        self.divider = json.dumps(builder.build_divider())
+        self.button = json.dumps(builder.build_approve_button())
+
+    @staticmethod
+    def marker(slot):
+        return f"@@SLOT{slot}@@"
+
+    @classmethod
+    def _compile(cls, block, slots):
+        serialized = json.dumps(block)
+        assert cls.SLOT.findall(serialized) == [cls.marker(i) for i in range(slots)]
+        return cls.SLOT.split(serialized)
+
+    @staticmethod
+    def _splice(parts, *values):
+        out = [parts[0]]
+        for value, part in zip(values, parts[1:]):
+            out.append(encode_basestring_ascii(value)[1:-1])
+            out.append(part)
+        return "".join(out)
+
+    def render(self, builder):
+        """Render a SlackTemplateBuilder straight to UTF-8 encoded JSON."""
+        return self.serialize(self._blocks(builder))
+
+    def iter_render(self, builder, items_per_message=ITEMS_PER_MESSAGE):
+        """Byte-for-byte equivalent of serializing each message yielded by
+        SlackTemplateBuilder.iter_templates.
+
+        """
+        for blocks in self.iter_blocks(builder, items_per_message):
+            yield self.serialize(blocks)
+
+    def iter_blocks(self, builder, items_per_message=ITEMS_PER_MESSAGE):
+        """The messages of iter_render as lists of serialized blocks, for
+        serialize() to join into each message.
+
+        """
+        for index in range(self.count_messages(builder, items_per_message)):
+            yield self.message_blocks(builder, index, items_per_message)
+
+    @staticmethod
+    def count_messages(builder, items_per_message=ITEMS_PER_MESSAGE):
+        """How many messages iter_blocks yields for builder."""
+        if builder.fits_one_message():
+            return 1
+        # The header, every full chunk of items, then the last chunk with the
+        # buttons, even when it has no items left.
+        return len(builder.resource_items) // min(items_per_message, ITEMS_PER_MESSAGE) + 2
+
+    def message_blocks(self, builder, index, items_per_message=ITEMS_PER_MESSAGE):
+        """The blocks of message index of iter_blocks, rendering that message
+        alone, so that a long finding can be sent from any message on.
+
+        """
+        if builder.fits_one_message():
+            return self._blocks(builder)
+        if index == 0:
+            return self._header(builder)
+        items_per_message = min(items_per_message, ITEMS_PER_MESSAGE)
+        items = builder.resource_items[(index - 1) * items_per_message:index * items_per_message]
+        chunk = [self._render_item(item) for item in items]
+        if index == self.count_messages(builder, items_per_message) - 1:
+            chunk.append(self.divider)
+            chunk.append(self.button)
+        return chunk
+
+    def _blocks(self, builder):
+        blocks = self._header(builder)
+        blocks.extend(self._render_item(item) for item in builder.resource_items)
+        blocks.append(self.divider)
+        blocks.append(self.button)
+        return blocks
+
+    def _header(self, builder):
+        return [
+            self._splice(self.title, format(builder.title)),
+            self._splice(
+                self.details,
+                format(builder.description),
+                format(builder.severity_type),
+                format(builder.compliance),
+                format(builder.resource_type),
+            ),
+            self.divider,
+        ]
+
+    def _render_item(self, item):
+        return self._splice(
+            self.item,
+            format(item.get("name")),
+            "apply-" + item.get("id"),
+            "not-apply-" + item.get("id"),
+        )
+
+    @staticmethod
+    def serialize(blocks):
+        """Join serialized blocks into one UTF-8 encoded message."""
+        return ('{"blocks": [' + ", ".join(blocks) + "]}").encode("utf-8")
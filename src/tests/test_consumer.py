@@ -0,0 +1,101 @@
+"""Consumer against the in-memory broker from benchmarks.fake_amqp."""
+import json
+import threading
+
+import pika
+from tornado.ioloop import IOLoop
+
+from consumer import Consumer
+from routing import FUNC_HANDLERS
+from benchmarks.fake_amqp import FakeBroker, FakeConnection, _Message
+
+ROUTING_KEY = "test.reconnect"
+PAYLOAD = {"id": "finding-1", "webhook_url": "https://hooks.example.invalid/1"}
+
+# Results the handler returns, in call order, each once the gate is open.
+_results = []
+_calls = []
+_gate = threading.Event()
+_started = threading.Event()
+
+
+@FUNC_HANDLERS.register(ROUTING_KEY)
+def _handler(payload):
+    _calls.append(payload["id"])
+    _started.set()
+    _gate.wait(5)
+    return _results.pop(0)
+
+
+def wait_until(ioloop, predicate, then, deadline=100):
+    if predicate():
+        then()
+    elif deadline:
+        ioloop.call_later(0.02, wait_until, ioloop, predicate, then, deadline - 1)
+    else:
+        ioloop.stop()
+
+
+def deliver_across_reconnect(results):
+    """Publish one message and lose the channel while it is being sent, so
+    that RabbitMQ redelivers it before the first copy has finished.
+
+    :return: how many times the handler ran, and the broker
+    """
+    _results[:] = results
+    _calls.clear()
+    _gate.clear()
+    _started.clear()
+    ioloop = IOLoop()
+    broker = FakeBroker(ioloop)
+
+    class TestConsumer(Consumer):
+        def connect(self):
+            return FakeConnection(broker, self.on_connection_open)
+
+    consumer = TestConsumer("amqp://test", "notification_queue", [ROUTING_KEY], queue_name="test")
+    first = {}
+
+    def publish():
+        properties = pika.BasicProperties(headers={})
+        broker.publish(_Message("notification_queue", ROUTING_KEY, json.dumps(PAYLOAD), properties))
+        wait_until(ioloop, _started.is_set, lose_channel)
+
+    def lose_channel():
+        first["channel"] = consumer._channel
+        consumer._channel.close()
+        wait_until(ioloop, lambda: consumer._channel is None, reconnect)
+
+    def reconnect():
+        consumer.reconnect()
+        wait_until(ioloop, lambda: any(consumer._claimed.values()), release)
+
+    def release():
+        _gate.set()
+        wait_until(ioloop, settled, ioloop.stop)
+
+    def settled():
+        channel = consumer._channel
+        return (not _results and channel is not None and channel is not first["channel"]
+                and not broker.queues["test"] and not channel._unacked)
+
+    ioloop.add_callback(wait_until, ioloop, lambda: broker.consuming, publish)
+    ioloop.call_later(10, ioloop.stop)
+    consumer.run()
+    ioloop.close(all_fds=True)
+    return list(_calls), broker
+
+
+def test_redelivered_copy_is_acked_once_the_first_is_sent():
+    calls, broker = deliver_across_reconnect([True])
+    assert calls == ["finding-1"]
+    assert not broker.queues["test"]
+
+
+def test_redelivered_copy_is_sent_when_the_first_fails():
+    calls, broker = deliver_across_reconnect([False, True])
+    assert calls == ["finding-1", "finding-1"]
+    assert not broker.queues["test"]
+    # The failed first copy belonged to the closed channel, so it was
+    # neither retried nor dead-lettered.
+    assert not any(broker.queues[name] for name in broker.queues if name != "test")
@@ -0,0 +1,189 @@
+import os
+import time
+import atexit
+import uuid
+import queue
+import random
+import tempfile
+import threading
+import contextlib
+
+import jsonlib
+from logpipeline import BatchWriter
+
+# Header Publisher stamps on every message, so spans recorded by any consumer
+# for that message can be put back together.
+TRACE_HEADER = "x-trace-id"
+
+# perf_counter is what spans are timed with, but trace viewers want wall
+# clock microseconds.
+_EPOCH_OFFSET = time.time() - time.perf_counter()
+
+_local = threading.local()
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+class Trace:
+    """Spans of one sampled message, written as Chrome trace events (the
+    JSON format read by chrome://tracing, Perfetto and speedscope) with the
+    trace id in their args.
+
+    """
+
+    __slots__ = ("tracer", "trace_id", "started")
+
+    def __init__(self, tracer, trace_id):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.started = time.perf_counter()
+
+    def record(self, name, started, ended=None):
+        ended = time.perf_counter() if ended is None else ended
+        self.tracer.emit({
+            "name": name,
+            "cat": "message",
+            "ph": "X",
+            "ts": round((started + _EPOCH_OFFSET) * 1e6),
+            "dur": round((ended - started) * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {"trace_id": self.trace_id},
+        })
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    def finish(self):
+        """Record the span covering the whole message."""
+        self.record("message", self.started)
+
+
+class RotatingTraceFile:
+    """File-like sink rotating to path.1 ... path.backup_count once it grows
+    past max_bytes. Each file starts with the "[" that opens a trace event
+    array; viewers accept the array without its closing bracket.
+
+    A batch of events is written one line, i.e. one event, at a time, so a
+    file never goes past max_bytes by more than a single event.
+
+    """
+
+    def __init__(self, path, max_bytes=50 * 2 ** 20, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = None
+        self._size = 0
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "wb")
+        self._file.write(b"[\n")
+        self._size = 2
+
+    def write(self, text):
+        for line in text.encode("utf-8").splitlines(keepends=True):
+            self._file.write(line)
+            self._size += len(line)
+            if self._size >= self.max_bytes:
+                self._rotate()
+
+    def flush(self):
+        self._file.flush()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        self._open()
+
+
+class _EventFormatter:
+    @staticmethod
+    def format(event):
+        return jsonlib.dumps(event).decode("utf-8") + ","
+
+
+class Tracer:
+    """Samples sample_rate of messages for tracing. Spans are queued and
+    written to the trace file by a background thread, so recording one costs
+    the calling thread a dict and a queue put.
+
+    """
+
+    def __init__(self, path, sample_rate=0.01, max_bytes=50 * 2 ** 20, backup_count=5):
+        self.sample_rate = sample_rate
+        self._events = queue.SimpleQueue()
+        self._writer = BatchWriter(self._events, RotatingTraceFile(path, max_bytes, backup_count), _EventFormatter())
+        self._writer.start()
+
+    def start(self, trace_id=None):
+        """A Trace for a newly received message, or None if it is not sampled."""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        return Trace(self, trace_id or new_trace_id())
+
+    def emit(self, event):
+        self._events.put(event)
+
+    def close(self):
+        self._writer.stop()
+
+
+def tracer_from_env():
+    """Build a Tracer when TRACE_SAMPLE_RATE is above 0, writing to
+    TRACE_FILE (per process by default) rotated at TRACE_MAX_BYTES.
+
+    """
+    sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+    if sample_rate <= 0:
+        return None
+    path = os.getenv("TRACE_FILE") or os.path.join(tempfile.gettempdir(), f"consumer-trace-{os.getpid()}.json")
+    tracer = Tracer(
+        path,
+        sample_rate=sample_rate,
+        max_bytes=int(os.getenv("TRACE_MAX_BYTES", 50 * 2 ** 20)),
+        backup_count=int(os.getenv("TRACE_BACKUP_COUNT", 5)),
+    )
+    atexit.register(tracer.close)
+    return tracer
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """Make trace the current one on this thread, for span()."""
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield
+    finally:
+        _local.trace = previous
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time a stage of the message being handled on this thread, if it is
+    being traced. Costs a thread-local lookup otherwise.
+
+    """
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
@@ -1,24 +1,110 @@
-import slack
 import os
 import hashlib
 import hmac
 import sys
 import json
-import requests
+import time
+import tempfile
+import threading
+import metrics
+from background import BoundedExecutor
+from state import state_store_from_env
+from dedup import seen_cache_from_env
 from pathlib import Path
 from dotenv import load_dotenv
 from flask import Flask, request, Response
-import string
 
 app = Flask(__name__)
 env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
-client = slack.WebClient(token=os.getenv("SLACK_TOKEN"))
-BOT_ID = client.api_call("auth.test")['user_id']
-
-message_counts = {}
-welcome_messages = {}
+# The Web API client and the bot's own user id are only looked up when an
+# event first needs them, so that importing this module stays cheap and works
+# offline. BOT_ID skips auth.test altogether, otherwise its answer is cached
+# in BOT_ID_CACHE for BOT_ID_CACHE_TTL seconds across restarts.
+BOT_ID_CACHE = os.getenv("BOT_ID_CACHE", os.path.join(tempfile.gettempdir(), "slack_bot_id.json"))
+BOT_ID_CACHE_TTL = int(os.getenv("BOT_ID_CACHE_TTL", 86400))
+
+_client = None
+_bot_id = os.getenv("BOT_ID")
+_init_lock = threading.RLock()
+
+# Per-user message counts and sent welcome messages, shared by every web
+# worker when STATE_BACKEND=redis.
+state = state_store_from_env()
+
+# Slack retries an event up to three times over about five minutes, each copy
+# carrying the same event_id.
+seen_events = seen_cache_from_env("slack_events", ttl=int(os.getenv("EVENT_DEDUP_TTL", 900)))
+
+# Slack retries any event not answered within 3 seconds, so events are acked
+# straight away and the Web API calls they lead to are made on this pool.
+event_workers = BoundedExecutor(
+    "slack-events",
+    max_workers=int(os.getenv("EVENT_WORKERS", 4)),
+    max_queued=int(os.getenv("EVENT_QUEUE_MAX", 100)),
+)
+
+EVENTS_RECEIVED = metrics.counter("web_slack_events_total", "Slack events received by event type", ["type"])
+INTERACTIONS_RECEIVED = metrics.counter("web_slack_interactions_total", "Slack interactive payloads received")
+EVENT_RETRIES = metrics.counter(
+    "web_slack_event_retries_total", "Events redelivered by Slack by X-Slack-Retry-Num", ["retry_num"])
+DUPLICATE_EVENTS = metrics.counter("web_slack_duplicate_events_total", "Redelivered events acked without processing")
+SIGNATURE_FAILURES = metrics.counter("web_signature_failures_total", "Requests rejected by signature verification")
+WEB_API_SECONDS = metrics.histogram(
+    "web_slack_api_seconds", "Slack Web API call latency by method", ["method"])
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _init_lock:
+            if _client is None:
+                import slack
+                _client = slack.WebClient(token=os.getenv("SLACK_TOKEN"))
+    return _client
+
+
+def _token_hash():
+    return hashlib.sha256(os.getenv("SLACK_TOKEN", "").encode()).hexdigest()
+
+
+def _read_cached_bot_id():
+    try:
+        with open(BOT_ID_CACHE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("token_hash") != _token_hash() or time.time() - cached.get("fetched_at", 0) > BOT_ID_CACHE_TTL:
+        return None
+    return cached.get("user_id")
+
+
+def _write_cached_bot_id(user_id):
+    # Written to a temporary file and renamed so that workers starting at the
+    # same time never read a partial file.
+    try:
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(BOT_ID_CACHE) or ".")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"user_id": user_id, "token_hash": _token_hash(), "fetched_at": time.time()}, f)
+        os.replace(path, BOT_ID_CACHE)
+    except OSError as e:
+        app.logger.warning(f"Could not cache the bot id in {BOT_ID_CACHE}: {e}")
+
+
+def get_bot_id():
+    global _bot_id
+    if _bot_id is None:
+        with _init_lock:
+            if _bot_id is None:
+                user_id = _read_cached_bot_id()
+                if user_id is None:
+                    started = time.perf_counter()
+                    user_id = get_client().api_call("auth.test")['user_id']
+                    WEB_API_SECONDS.observe(time.perf_counter() - started, method="auth.test")
+                    _write_cached_bot_id(user_id)
+                _bot_id = user_id
+    return _bot_id
 
 
 class WelcomeMessage:
@@ -98,18 +184,24 @@ def verify_signature(signing_secret, timestamp, signature):
 
 
 def send_welcome_message(channel, user):
-    if channel not in welcome_messages:
-        welcome_messages[channel] = {}
-
-    if user in welcome_messages[channel]:
+    # Claim the welcome before sending it so that two workers handling the
+    # same user at once don't both post one.
+    welcome_key = f"welcome:{channel}"
+    if not state.hsetnx(welcome_key, user, {'ts': '', 'completed': False}):
         return
 
     welcome = WelcomeMessage(channel)
     message = welcome.get_message()
-    response = client.chat_postMessage(**message)
+    started = time.perf_counter()
+    try:
+        response = get_client().chat_postMessage(**message)
+    except Exception:
+        state.hdel(welcome_key, user)
+        raise
+    WEB_API_SECONDS.observe(time.perf_counter() - started, method="chat.postMessage")
     welcome.timestamp = response['ts']
 
-    welcome_messages[channel][user] = welcome
+    state.hset(welcome_key, user, {'ts': welcome.timestamp, 'completed': welcome.completed})
 
 
 def reply_message(payload):
@@ -118,18 +210,17 @@ def reply_message(payload):
     user_id = event.get('user')
     text = event.get('text')
 
-    if user_id != None and BOT_ID != user_id:
-        if user_id in message_counts:
-            message_counts[user_id] += 1
-        else:
-            message_counts[user_id] = 1
+    if user_id != None and get_bot_id() != user_id:
+        state.incr(f"message_count:{user_id}")
 
         if text.lower() == 'start':
             send_welcome_message(f'@{user_id}', user_id)
         else:
             ts = event.get('ts')
-            client.chat_postMessage(
+            started = time.perf_counter()
+            get_client().chat_postMessage(
                 channel=channel_id, thread_ts=ts, text="THAT IS A BAD WORD!")
+            WEB_API_SECONDS.observe(time.perf_counter() - started, method="chat.postMessage")
 
 
 @app.route("/")
@@ -138,12 +229,16 @@ def hello():
     return "Hello there!"
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route("/slack/interactive", methods=['GET', 'POST'])
 def slack_interactive():
-    headers = request.headers
-    print(headers)
+    INTERACTIONS_RECEIVED.inc()
     event_data = json.loads(request.form['payload'])
-    print(event_data)
+    app.logger.debug('Interactive payload %s with headers %s', event_data, request.headers)
     # requests.post(event_data['response_url'])
     return "success", 200
 
@@ -154,17 +249,33 @@ def slack_webhook():
     req_timestamp = request.headers.get('X-Slack-Request-Timestamp')
 
     if req_signature is None or not verify_signature(os.environ['SIGNING_SECRET'], req_timestamp, req_signature):
+        SIGNATURE_FAILURES.inc()
         return "", 403
 
     event_data = json.loads(request.data.decode('utf-8'))
 
+    retry_num = request.headers.get('X-Slack-Retry-Num')
+    if retry_num is not None:
+        EVENT_RETRIES.inc(retry_num=retry_num)
+    # Claimed in one step, so that copies of an event arriving together on
+    # different workers can't both get past the check.
+    event_id = event_data.get("event_id") if seen_events is not None else None
+    if event_id and not seen_events.add_if_absent(event_id):
+        DUPLICATE_EVENTS.inc()
+        return "", 200
+
     if "challenge" in event_data:
         return {"challenge": event_data.get("challenge")}, 200
 
     # Parse the Event payload and emit the event to the event listener
     if "event" in event_data:
         event_type = event_data["event"]["type"]
-        reply_message(event_data)
+        EVENTS_RECEIVED.inc(type=event_type)
+        if not event_workers.submit(reply_message, event_data):
+            # Slack will retry the event, which must not be taken as a duplicate.
+            if event_id:
+                seen_events.discard(event_id)
+            return "", 503
         return "", 200
 
 